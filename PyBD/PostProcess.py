@@ -1,155 +1,278 @@
 # Process PyBD output for panel detector concept.
 # C. Awe  - 9/18/2018
 
-import ROOT
+import os
+import argparse
 import random
-from ROOT import TGraph, TH1D, TH1F, TH2F, TCanvas, TFile, TTree
 import numpy as np
-import scipy as sp
-import matplotlib as mpl
-import pandas as pds
-import sklearn as skl
-from array import array
-from tqdm import tqdm
+import uproot
+from histograms import Histogram
+from panelGeometry import PanelStack, getDirections
+from treeReader import iterateTree, readTree
 
 m_e = 0.5109989 # Electron mass in MeV/c^2
 m_n = 939.56536 # Neutron mass in MeV/c^2
-m_n_kg = 1.6749286E-27 # Neutron mass in kg
-MeV_to_J = 1.6021773e-13 # Converts MeV to Joules
-mps_to_cmpns = 1e-7 # Converts m/s to cm/ns
+c_cmpns = 29.9792458 # Speed of light in cm/ns
+
+# As in PyBD.py, the formulas below are written once in array form (suffix Arr)
+# and the original scalar functions wrap them.
+
+# Neutron beta = p / E from kinetic energy k_n in MeV (exact, any energy). Uses
+# p^2 = k_n ( k_n + 2 m_n ) rather than E_n^2 - m_n^2, which cancels badly for keV neutrons.
+def getNtronBetaArr( k_n ):
+	return np.sqrt( k_n * ( k_n + 2 * m_n ) ) / ( k_n + m_n )
+
+# Compute neutron velocity in cm/ns from total energy E_n in MeV (relativistic,
+# so also correct for the faster neutrons of supernova spectra).
+def getNtronVelocityArr( E_n ):
+	return c_cmpns * getNtronBetaArr( E_n - m_n )
 
-# Compute neutron velocity in cm/ns
 def getNtronVelocity( E_n ):
-	# Get neutron kinetic energy.
-	k_n = E_n - m_n
-	# Convert to joules.
-	k_n *= MeV_to_J
-	# Get velocity (assumes non-relativistic energies, good for most IBD scenarios)
-	return float( mps_to_cmpns * np.sqrt( 2 * k_n / m_n_kg ) )
+	return float( getNtronVelocityArr( E_n ) )
 
 # Full 3D case
 def getPhi():
 	return random.uniform( 0, 2.0 * np.pi )
 
-# Randomly generate IBD position (horizontal)	
+# Randomly generate IBD position (horizontal)
 def getX( h ):
  return random.uniform( 0, h )
 
-# Randomly generate IBD position (vertical)	
+# Randomly generate IBD position (vertical)
 def getY( h ):
  return random.uniform( 0, h )
 
+# Batch versions of getPhi, getX and getY, rng is a numpy Generator.
+def getPhis( n, rng ):
+	return rng.uniform( 0, 2.0 * np.pi, n )
+
+def getXs( h, n, rng ):
+	return rng.uniform( 0, h, n )
+
+def getYs( h, n, rng ):
+	return rng.uniform( 0, h, n )
+
 # Compute neutron TOF
 # d = panel seperation in cm
-# h = panel height in cm 
+# h = panel height in cm
 # theta = neutron angle in radians
 # y = IBD vertical position in cm
 # x = IBD horizontal position in cm
+# phi = neutron azimuth in radians
 # Neglecting panel thickness for now
-def getNtronTOF( d, h, theta, x, y, E_n):
-	# Check if the neutron is going to miss the next panel.
-	phi = getPhi()
-	v_n = getNtronVelocity( E_n )
-	y_n = float( d * np.tan( theta ) )
-	# Dummy variable to record neutron displacement off neutrino axis.
-	h_n = y_n
-	# Compute horizontal displacement.
+# Neutrons that miss the next panel get an unphysical TOF of -1.
+def getNtronTOFArr( d, h, theta, x, y, E_n, phi ):
+	v_n = getNtronVelocityArr( E_n )
+	# Neutron displacement off the neutrino axis at the next panel.
+	h_n = d * np.tan( theta )
 	# Adjust neutron position by a phi rotation.
-	x_n = float( y_n * np.sin( phi ) ) 
-	y_n *= np.cos( phi )
-	y_n += y # Neutron vertical position.
-	x_n += x # Neutron horizontal position.
-	if ( y_n > h ):
-		# If so, assign an unphysical value.
-		return -1.0
-	elif ( y_n < 0 ):
-		# If so, assign an unphysical value.
-		return -1.0
-	elif ( x_n > h ):
-		# If so, assign an unphysical value.
-		return -1.0
-	elif ( x_n < 0 ):
-		# If so, assign an unphysical value.
-		return -1.0
-	else: 
-		# Good event, compute TOF.
-		return float( np.sqrt( np.square( d ) + np.square( h_n ) ) / v_n )
-	
-def main():
-	# Initialize dummy arrays
-	TOF = array( 'd', [0] )
-	E_v = array( 'd', [0] )
-	E_e = array( 'd', [0] )
-	E_n = array( 'd', [0] )
-	cos_theta_n = array( 'd', [0] )
-	cos_theta_e = array( 'd', [0] )
-	dCC = array( 'd', [0] )
-	angl = array( 'd', [0] )
-	theta_n = array( 'd', [0] )
-	
-	# Prompt user for input file and run parameters
-	#filename = input( "Enter the path to the PyBD output file: " )
-	#d = input( "Enter panel seperation in cm: " )
-	#h = input( "Enter panel height in cm: " )
-	#output = input( "Enter the path and name of the output file you wish to produce: " )
-	filename = "~/Desktop/PyBD/RootSpectra/reactor_1e6.root"
-	d = 30.0
-	h = 30.0
-	output = "~/Desktop/PyBD/PostProcessed/reactorPanels.root"
-
-	# Load in root file.
-	f = ROOT.TFile( filename )
-	ibdTree = f.Get( "eventTree" )
-	ibdTree.SetBranchAddress( "E_v", E_v )
-	ibdTree.SetBranchAddress( "E_e", E_e )
-	ibdTree.SetBranchAddress( "E_n", E_n )
-	ibdTree.SetBranchAddress( "cos_theta_n", cos_theta_n )
-	ibdTree.SetBranchAddress( "cos_theta_e", cos_theta_e )
-	angl = array( 'd', [0] )
-	ibdTree.SetBranchAddress( "dCC", dCC )
-		
-	# Declare a new TTree with branches to hold our processed values
-	processedFile = ROOT.TFile( output, "recreate" )
-	processedTree = ibdTree.CloneTree(0)
-	processedTree.Branch( "TOF", TOF, "TOF/D" )
-	
-	# Declare histograms to hold CC weighted events
-	En_v_TOF = ROOT.TH2F("En_v_TOF","Time of Flight vs. Neutron Energy",2000,0,200,1000,0,1000)
-	engyHist_1 = ROOT.TH2F("engyHist_1","Neutron Energy vs. Positron Energy for TOF = 200 +/- 2 ns",50,0,5,400,0,40)
-	engyHist_2 = ROOT.TH2F("engyHist_2","Neutron Energy vs. Positron Energy for TOF = 150 +/- 2 ns",50,0,5,400,0,40)
-	engyHist_3 = ROOT.TH2F("engyHist_3","Neutron Energy vs. Positron Energy for TOF = 300 +/- 2 ns",50,0,5,400,0,40)
-	engyHist_4 = ROOT.TH2F("engyHist_3","Neutron Energy vs. Positron Energy for TOF = 250 +/- 2 ns",50,0,5,400,0,40)
-			
-	# Step through each event and compute TOF
-	numEvents = ibdTree.GetEntries()
-	for i in tqdm( range( 0, 500000 ) ):
-		ibdTree.GetEntry( i )
-		phi = getPhi()
-		x = getX( h )
-		y = getY( h )
-		theta_n = np.arccos( cos_theta_n[0] )
-		TOF[0] = getNtronTOF( d, h, theta_n, x, y, E_n[0] )
-		processedTree.Fill()
-		En_v_TOF.Fill( 1000 * ( E_n[0] - m_n ), TOF[0], dCC[0] )
-		if ( TOF[0] > 198 and TOF[0] < 202 ):
-			engyHist_1.Fill( E_e[0] - m_e, 1000 * ( E_n[0] - m_n ), dCC[0] )
-			En_v_TOF.Fill( 1000 * ( E_n[0] - m_n ), TOF[0], dCC[0] )
-		if ( TOF[0] > 148 and TOF[0] < 152 ):
-			engyHist_2.Fill( E_e[0] - m_e, 1000 * ( E_n[0] - m_n ), dCC[0] )
-			En_v_TOF.Fill( 1000 * ( E_n[0] - m_n ), TOF[0], dCC[0] )
-		if ( TOF[0] > 298 and TOF[0] < 302 ):
-			engyHist_3.Fill( E_e[0] - m_e, 1000 * ( E_n[0] - m_n ), dCC[0] )
-		if ( TOF[0] > 248 and TOF[0] < 252 ):
-			engyHist_4.Fill( E_e[0] - m_e, 1000 * ( E_n[0] - m_n ), dCC[0] )
-		#print "TOF = " + str( TOF[0] ) + " ns."
-		
-	# Write to an output file
-	processedFile.Write()
-	processedFile.Close()
-	
-#Execute main function 	
+	x_n = h_n * np.sin( phi ) + x # Neutron horizontal position.
+	y_n = h_n * np.cos( phi ) + y # Neutron vertical position.
+	# Check if the neutron is going to miss the next panel.
+	hit = ( y_n <= h ) & ( y_n >= 0 ) & ( x_n <= h ) & ( x_n >= 0 )
+	return np.where( hit, np.sqrt( np.square( d ) + np.square( h_n ) ) / v_n, -1.0 )
+
+def getNtronTOF( d, h, theta, x, y, E_n):
+	return float( getNtronTOFArr( d, h, theta, x, y, E_n, getPhi() ) )
+
+# Event weight, trees written since PyBD's generation modes carry a weight branch
+# (equal to dCC for weighted runs), older ones only dCC.
+def getWeights( events ):
+	if "weight" in events:
+		return events["weight"]
+	return events["dCC"]
+
+# Default TOF windows ( center, half width ) in ns used for the energy histogram and
+# scan yields. A window holds center - half width < TOF < center + half width.
+tofWindows = [ ( 200, 2 ), ( 150, 2 ), ( 300, 2 ), ( 250, 2 ) ]
+
+# Sorted window edges [ low_0, high_0, low_1, high_1, ... ] and, for each sorted
+# window, its index in the list given. Windows may touch but not overlap.
+def getWindowEdges( windows ):
+	low = np.array( [ center - halfWidth for center, halfWidth in windows ], dtype=float )
+	high = np.array( [ center + halfWidth for center, halfWidth in windows ], dtype=float )
+	order = np.argsort( low, kind="stable" )
+	low = low[order]
+	high = high[order]
+	if np.any( high <= low ) or np.any( high[:-1] > low[1:] ):
+		raise ValueError( "TOF windows must have positive width and must not overlap" )
+	return np.column_stack( ( low, high ) ).ravel(), order
+
+# Index of the window each TOF falls in (-1 for none), one searchsorted per batch
+# however many windows there are.
+def assignWindows( TOF, edges, order ):
+	# Number of edges below TOF, odd means past a low edge but not past its high edge.
+	position = np.searchsorted( edges, TOF, side="left" )
+	inside = ( position % 2 == 1 ) & ( TOF < edges[ np.minimum( position, len( edges ) - 1 ) ] )
+	return np.where( inside, order[ np.minimum( position // 2, len( order ) - 1 ) ], -1 )
+
+# Histogram of TOF window x positron energy x neutron energy, window bin i+1 is windows[i].
+def makeWindowHistogram( windows ):
+	return Histogram( "engyVsTOFWindow", "TOF Window vs. Positron Energy vs. Neutron Energy",
+	[ ( len( windows ), 0, len( windows ) ), ( 50, 0, 5 ), ( 400, 0, 40 ) ] )
+
+# Fill the window histogram for a block of events.
+def fillWindowHistogram( hist, window, T_e, T_n, weights ):
+	inWindow = window >= 0
+	hist.fill( window[inWindow], T_e[inWindow], T_n[inWindow], weights=weights[inWindow] )
+
+# Parse "center:halfWidth" (ns) from the command line.
+def parseWindow( text ):
+	center, halfWidth = text.split( ":" )
+	return ( float( center ), float( halfWidth ) )
+
+# Random IBD positions and neutron azimuths for n events. Positions are kept as
+# fractions of the panel height (and thickness) so the same draws can be reused
+# for any geometry.
+def drawPositions( n, rng ):
+	return { "u_x": rng.random( n ), "u_y": rng.random( n ), "phi": getPhis( n, rng ), "u_z": rng.random( n ) }
+
+# Trace a block of events through a stack of numPanels panels of the given
+# thickness (cm), fronts d apart, IBD inside panel 0. See panelGeometry.py.
+def tracePanels( events, d, h, positions, thickness, numPanels=2, interactionLength=None ):
+	stack = PanelStack.regular( numPanels, d, thickness, h )
+	origins = np.column_stack( ( positions["u_x"] * h, positions["u_y"] * h, positions["u_z"] * thickness ) )
+	directions = getDirections( np.arccos( events["cos_theta_n"] ), positions["phi"] )
+	return stack.trace( origins, directions, 0, interactionLength, getNtronVelocityArr( events["E_n"] ) )
+
+# Compute TOF for a block of events (dict of numpy columns) at given positions.
+# Thin panels use the original two-plane formula, otherwise the stack is ray traced
+# and TOF is to the entry face of the first panel hit. Misses get TOF = -1.
+def computeTOFAt( events, d, h, positions, thickness=0.0, numPanels=2 ):
+	if thickness == 0 and numPanels == 2:
+		theta_n = np.arccos( events["cos_theta_n"] )
+		x = positions["u_x"] * h
+		y = positions["u_y"] * h
+		return getNtronTOFArr( d, h, theta_n, x, y, events["E_n"], positions["phi"] )
+	trace = tracePanels( events, d, h, positions, thickness, numPanels )
+	return np.where( trace["firstHit"] >= 0, trace["firstHitTOF"], -1.0 )
+
+# Compute TOF for a block of events with fresh random positions.
+def computeTOF( events, d, h, rng, thickness=0.0, numPanels=2 ):
+	return computeTOFAt( events, d, h, drawPositions( len( events["E_n"] ), rng ), thickness, numPanels )
+
+# Evaluate every ( d, h ) geometry on the same events and the same random
+# positions, so differences between geometries are not washed out by sampling
+# noise. Returns one summary row (dict) per geometry.
+def scanGeometries( events, dValues, hValues, rng, windows=tofWindows, thickness=0.0, numPanels=2 ):
+	edges, order = getWindowEdges( windows )
+	positions = drawPositions( len( events["E_n"] ), rng )
+	weights = getWeights( events )
+	totalWeight = np.sum( weights )
+	rows = []
+	for d in dValues:
+		for h in hValues:
+			TOF = computeTOFAt( events, d, h, positions, thickness, numPanels )
+			hit = TOF >= 0
+			row = { "d": d, "h": h, "efficiency": np.sum( weights[hit] ) / totalWeight,
+				"hits": int( np.count_nonzero( hit ) ), "hitWeight": np.sum( weights[hit] ),
+				"meanTOF": np.average( TOF[hit], weights=weights[hit] ) if np.any( hit ) else -1.0 }
+			window = assignWindows( TOF, edges, order )
+			inWindow = window >= 0
+			yields = np.bincount( window[inWindow], weights[inWindow], len( windows ) )
+			for ( center, halfWidth ), windowYield in zip( windows, yields ):
+				row[getWindowName( center, halfWidth )] = windowYield
+			rows.append( row )
+	return rows
+
+def getWindowName( center, halfWidth ):
+	return "TOF_%g+-%g" % ( center, halfWidth )
+
+# Write scan rows as a comma separated table.
+def writeSummary( rows, filename ):
+	columns = list( rows[0].keys() )
+	with open( filename, "w" ) as summary:
+		summary.write( ",".join( columns ) + "\n" )
+		for row in rows:
+			summary.write( ",".join( "%.6g" % row[c] for c in columns ) + "\n" )
+
+def getParser():
+	parser = argparse.ArgumentParser( description="Panel detector post-processing of PyBD output" )
+	parser.add_argument( "--input", default="~/Desktop/PyBD/RootSpectra/reactor_1e6.root", help="PyBD output file" )
+	parser.add_argument( "--output", default="~/Desktop/PyBD/PostProcessed/reactorPanels.root", help="processed output file" )
+	parser.add_argument( "--separation", type=float, default=30.0, help="panel seperation (d) in cm" )
+	parser.add_argument( "--height", type=float, default=30.0, help="panel height (h) in cm" )
+	parser.add_argument( "--thickness", type=float, default=0.0, help="panel thickness in cm (0 = thin planes)" )
+	parser.add_argument( "--panels", type=int, default=2, help="number of panels in the stack" )
+	parser.add_argument( "--interaction-length", type=float, default=None,
+	help="neutron interaction length in the panels (cm), adds per-event capture probabilities" )
+	parser.add_argument( "--seed", type=int, default=None, help="random seed" )
+	parser.add_argument( "--chunk-size", type=int, default=100000, help="events read and processed at a time" )
+	parser.add_argument( "--entry-start", type=int, default=None, help="first entry to process" )
+	parser.add_argument( "--entry-stop", type=int, default=None, help="stop before this entry" )
+	parser.add_argument( "--scan-separation", type=float, nargs="+", help="panel seperations (cm) for a geometry scan" )
+	parser.add_argument( "--scan-height", type=float, nargs="+", help="panel heights (cm) for a geometry scan" )
+	parser.add_argument( "--windows", type=parseWindow, nargs="+", default=tofWindows,
+	help="TOF windows as center:halfWidth in ns (default 200:2 150:2 300:2 250:2)" )
+	parser.add_argument( "--summary", default="geometryScan.csv", help="summary table written by a geometry scan" )
+	return parser
+
+# Branches the scan needs, the only ones it keeps in memory.
+scanBranches = [ "E_e", "E_n", "cos_theta_n", "dCC", "weight" ]
+
+# Load the event tree columns needed by the geometry scan.
+def loadEvents( filename, chunkSize=100000, entryStart=None, entryStop=None ):
+	available = set( next( iterateTree( filename, chunkSize=1, entryStop=1 ) ).keys() )
+	branches = [ b for b in scanBranches if b in available ]
+	return readTree( filename, branches=branches, chunkSize=chunkSize, entryStart=entryStart, entryStop=entryStop )
+
+# Compute TOF (and trace output) for one chunk, adding the new columns to events.
+def processChunk( events, args, rng ):
+	d = args.separation
+	h = args.height
+	positions = drawPositions( len( events["E_n"] ), rng )
+	if args.interaction_length is None:
+		events["TOF"] = computeTOFAt( events, d, h, positions, args.thickness, args.panels )
+	else:
+		# Full trace, also keep which panel is hit first and the probability the
+		# neutron interacts in any panel after leaving the source panel.
+		trace = tracePanels( events, d, h, positions, args.thickness, args.panels, args.interaction_length )
+		events["TOF"] = np.where( trace["firstHit"] >= 0, trace["firstHitTOF"], -1.0 )
+		events["hitPanel"] = trace["firstHit"].astype( np.int32 )
+		events["captureProb"] = np.sum( trace["captureProbability"][:, 1:], axis=1 )
+	return events
+
+def main( argv=None ):
+	args = getParser().parse_args( argv )
+	rng = np.random.default_rng( args.seed )
+
+	# Geometry scan, defaults to the single separation or height if only one list is given.
+	if args.scan_separation is not None or args.scan_height is not None:
+		events = loadEvents( args.input, args.chunk_size, args.entry_start, args.entry_stop )
+		dValues = args.scan_separation if args.scan_separation is not None else [ args.separation ]
+		hValues = args.scan_height if args.scan_height is not None else [ args.height ]
+		rows = scanGeometries( events, dValues, hValues, rng, args.windows, args.thickness, args.panels )
+		writeSummary( rows, args.summary )
+		print( "Wrote " + str( len( rows ) ) + " geometries to " + args.summary )
+		return
+
+	# Histograms to hold CC weighted events
+	En_v_TOF = Histogram( "En_v_TOF", "Time of Flight vs. Neutron Energy", [ ( 2000, 0, 200 ), ( 1000, 0, 1000 ) ] )
+	edges, order = getWindowEdges( args.windows )
+	engyHist = makeWindowHistogram( args.windows )
+
+	# Stream the event tree, compute TOF and write out chunk by chunk.
+	processedFile = uproot.recreate( os.path.expanduser( args.output ) )
+	processedTree = None
+	for events in iterateTree( args.input, chunkSize=args.chunk_size, entryStart=args.entry_start, entryStop=args.entry_stop ):
+		events = processChunk( events, args, rng )
+		weights = getWeights( events )
+		T_n = 1000 * ( events["E_n"] - m_n )
+		T_e = events["E_e"] - m_e
+		TOF = events["TOF"]
+		En_v_TOF.fill( T_n, TOF, weights=weights )
+		fillWindowHistogram( engyHist, assignWindows( TOF, edges, order ), T_e, T_n, weights )
+		if processedTree is None:
+			processedTree = processedFile.mktree( "eventTree", { name: column.dtype for name, column in events.items() } )
+		processedTree.extend( events )
+
+	for hist in [ En_v_TOF, engyHist ]:
+		processedFile[hist.name] = hist.toWritable()
+	# Window definitions, row i is window bin i+1 of engyVsTOFWindow.
+	processedFile["tofWindows"] = { "center": np.array( [ w[0] for w in args.windows ] ),
+		"halfWidth": np.array( [ w[1] for w in args.windows ] ) }
+	processedFile.close()
+
+#Execute main function
 if __name__== "__main__":
   main()
-	
-	
-		
@@ -17,16 +17,20 @@
 #                                    hbar = 1                                                #
 #                              cross sections in MeV^-2                                      #
 
-import ROOT
+#Only light modules are imported here. ROOT (spectrum input), uproot (output) and
+#scipy (spline cross section tables) are imported where they are used, so short
+#runs and modules that just need the physics do not pay their import time.
+import os
+import sys
+import argparse
+import configparser
 import random
-from ROOT import TGraph, TH1D, TH1F, TH2F, TCanvas, TFile, TTree
 import numpy as np
-import scipy as sp
-import matplotlib as mpl
-import pandas as pds
-import sklearn as skl
-from array import array
 from tqdm import tqdm
+from spectrumSampler import SpectrumSampler
+from aliasTable import AliasTable
+from supernovaSource import SupernovaSource
+from eventWriter import EventWriter, outputFormats
 
 cos_theta_c = 0.9742915 #Cosine of the Cabibo angle.
 g_f = 1.16637e-11 #Fermi coupling constant in MeV^-2.
@@ -35,6 +39,7 @@ m_n = 939.56536 #Neutron mass in MeV/c^2
 m_e = 0.5109989 #Electron mass in MeV/c^2
 m_A = 1e3 #Constant term in form factor expressions.
 m_V = 842.615 #Constant term in form factor expressions.
+g0 = -1.270 #Axial vector coupling, g1 at t = 0.
 m = 938.9 #Average nucleon mass in MeV/c^2.
 m_pi = 134.976 #Charged pion mass.
 #Constant term defined in Strumia.
@@ -49,50 +54,70 @@ numSamples = 1000 #Number of values to take for numerical integration.
 ############# Basic Math Functions #############
 ################################################
 
+#Every formula below is written once in an array-safe form (suffix Arr) that
+#accepts numpy arrays of any broadcastable shape. The original scalar functions
+#are thin wrappers around these, so the per-event and batch paths share the
+#exact same arithmetic.
+
 #Computes epsilon (we go to NLO in epsilon).
+def epsilonArr( E_v ):
+	return E_v / m_p
+
 def epsilon( E_v ):
-	return float( E_v / m_p )
-	
-#Computes kappa, just a number that shows up in the equations.	
+	return float( epsilonArr( E_v ) )
+
+#Computes kappa, just a number that shows up in the equations.
+def kappaArr( e, cos_theta_e ):
+	return np.square( 1 + e ) - np.square( e * cos_theta_e )
+
 def kappa( e, cos_theta_e ):
-	return float( np.square( 1 + e ) - np.square( e * cos_theta_e ) )
+	return float( kappaArr( e, cos_theta_e ) )
+
+#Computes positron energy given E_nu and theta_e
+def posEnergyArr( E_v, cos_theta_e ):
+	e = epsilonArr( E_v )
+	k = kappaArr( e, cos_theta_e )
+	return ( ( E_v - delta ) * ( 1 + e ) + e * cos_theta_e * np.sqrt(
+	np.square( E_v - delta ) - np.square( m_e ) * k ) ) / k
 
-#Computes positron energy given E_nu and theta_e	
 def posEnergy( E_v, cos_theta_e ):
-	e = epsilon( E_v )
-	k = kappa( e, cos_theta_e )
-	return float( ( ( E_v - delta ) * ( 1 + e ) + e * cos_theta_e * np.sqrt(
-	np.square( E_v - delta ) - np.square( m_e ) * k ) ) / k )
+	return float( posEnergyArr( E_v, cos_theta_e ) )
+
+#Computes positron momentum given E_e
+def posMomentumArr( E_e ):
+	return np.sqrt( np.square( E_e ) - np.square( m_e ) )
 
-#Computes positron momentum given E_e	
 def posMomentum( E_e ):
-	return float( np.sqrt( np.square( E_e ) - np.square( m_e ) ) )
+	return float( posMomentumArr( E_e ) )
+
+#Computes neutron energy given E_nu and E_e
+def ntronEnergyArr( E_v, E_e ):
+	return E_v + m_p - E_e
 
-#Computes neutron energy given E_nu and E_e	
 def ntronEnergy( E_v, E_e ):
-	global m_p
-	return float( E_v + m_p - E_e )
+	return float( ntronEnergyArr( E_v, E_e ) )
 
 #Computes neutron momentum given neutron energy.
+def ntronMomentumArr( E_n ):
+	return np.sqrt( np.square( E_n ) - np.square( m_n ) )
+
 def ntronMomentum( E_n ):
 	#print E_n - m_n
-	return float( np.sqrt( np.square( E_n ) - np.square( m_n ) ) )
-	
+	return float( ntronMomentumArr( E_n ) )
+
 #Computes neutron angle given neutrino energy and positron angle.
-def ntronAngle( E_v, cos_theta_e, P_e, P_n ):
-	#Calculate neutron scattering angle.
-	ntronAngl = float( ( E_v - P_e * cos_theta_e ) / P_n )
+def ntronAngleArr( E_v, cos_theta_e, P_e, P_n ):
 	#Check that cos_theta_n <= 1. This can fail in extreme cases where rounding becomes important.
-	if ( ntronAngl > 1.0 ):
-		#print "Warning: Numerical Rounding Error, cos_theta_n > 1"
-		#print "This may indicate unphysical neutrino energies. Setting to 1.0.""
-		ntronAngl = 1.0
-	return ntronAngl
+	#Such values may indicate unphysical neutrino energies, they are clipped to 1.0.
+	return np.minimum( ( E_v - P_e * cos_theta_e ) / P_n, 1.0 )
+
+def ntronAngle( E_v, cos_theta_e, P_e, P_n ):
+	return float( ntronAngleArr( E_v, cos_theta_e, P_e, P_n ) )
 
-#Computes the opening angle between the daughter particles.	
+#Computes the opening angle between the daughter particles (works on scalars and arrays).
 def openingAngle( cos_theta_e, cos_theta_n ):
 	return np.arccos( cos_theta_e ) * 180.0 / np.pi +  np.arccos( cos_theta_n ) * 180.0 / np.pi
-	
+
 #############################################
 ############## Build 4-Vectors ##############
 #############################################
@@ -126,75 +151,157 @@ def get_ntron_vec( E_n, cos_theta_n, P_n ):
 ########### Build Mandelstrom Vars ###########
 ##############################################
 
+def getSArr( E_v ):
+	return m_p * m_p + 2 * E_v * m_p
+
 def getS( E_v ):
-	return float( m_p * m_p + 2 * E_v * m_p )
+	return float( getSArr( E_v ) )
 
-def getT( E_v, E_e, cos_theta_e, P_e ):
-	sin_theta_e = float( np.sqrt( 1 - np.square( cos_theta_e ) ) )
-	return float( np.square( E_v - E_e ) - np.square( E_v - P_e * cos_theta_e ) 
+def getTArr( E_v, E_e, cos_theta_e, P_e ):
+	sin_theta_e = np.sqrt( 1 - np.square( cos_theta_e ) )
+	return ( np.square( E_v - E_e ) - np.square( E_v - P_e * cos_theta_e )
 	- np.square( P_e * sin_theta_e ) )
 
-def getU( E_v, E_n, cos_theta_n, P_n ):
+def getT( E_v, E_e, cos_theta_e, P_e ):
+	return float( getTArr( E_v, E_e, cos_theta_e, P_e ) )
+
+def getUArr( E_v, E_n, cos_theta_n, P_n ):
 	sin_theta_n = np.sqrt( 1 - np.square( cos_theta_n ) )
-	return float( np.square( E_v - E_n ) - np.square( E_v - P_n * cos_theta_n ) 
+	return ( np.square( E_v - E_n ) - np.square( E_v - P_n * cos_theta_n )
 	- np.square( P_n * sin_theta_n ) )
 
+def getU( E_v, E_n, cos_theta_n, P_n ):
+	return float( getUArr( E_v, E_n, cos_theta_n, P_n ) )
+
 #############################################
 ############# Build Form Factors ############
 #############################################
 
+def getf1Arr( t ):
+	return ( ( 1 - ( 1 + ksi ) * t / ( 4 * np.square( m ) ) ) / ( ( 1 - t / ( 4 * np.square( m ) ) )
+	* np.square( 1 - t / np.square( m_V ) ) ) )
+
 def getf1( t ):
-	return float( ( 1 - ( 1 + ksi ) * t / ( 4 * np.square( m ) ) ) / ( ( 1 - t / ( 4 * np.square( m ) ) )
+	return float( getf1Arr( t ) )
+
+def getf2Arr( t ):
+	return ( (ksi ) / ( ( 1 - t / ( 4 * np.square( m ) ) )
 	* np.square( 1 - t / np.square( m_V ) ) ) )
 
 def getf2( t ):
-	return float( (ksi ) / ( ( 1 - t / ( 4 * np.square( m ) ) )
-	* np.square( 1 - t / np.square( m_V ) ) ) )
+	return float( getf2Arr( t ) )
+
+def getg1Arr( t ):
+	return g0 / np.square( 1 - t / np.square( m_A ) )
 
 def getg1( t ):
-	g0 = -1.270
-	return float( g0 / np.square( 1 - t / np.square( m_A ) ) )
-	
-#Not needed for NLO approximation, but appears in the full expression.	
+	return float( getg1Arr( t ) )
+
+#Not needed for NLO approximation, but appears in the full expression.
+def getg2Arr( t, g1 ):
+	return 2 * np.square( m ) * g1 / ( np.square( m_pi ) - t )
+
 def getg2( t, g1 ):
-	return float( 2 * np.square( m ) * g1 / ( np.square( m_pi ) - t ) )
-	
-def getA( t, f1, g1, f2 ):
-	return float( np.square( m ) * ( np.square( f1 ) - np.square( g1 ) )
-	* ( t - np.square( m_e ) ) - np.square( m ) * np.square( D ) * 
+	return float( getg2Arr( t, g1 ) )
+
+def getAArr( t, f1, g1, f2 ):
+	return ( np.square( m ) * ( np.square( f1 ) - np.square( g1 ) )
+	* ( t - np.square( m_e ) ) - np.square( m ) * np.square( D ) *
 	( np.square( f1 ) - np.square( g1 ) ) - 2 * np.square( m_e ) *
 	m * D * g1 * ( f1 + f2 ) )
 
+def getA( t, f1, g1, f2 ):
+	return float( getAArr( t, f1, g1, f2 ) )
+
+def getBArr( t, f1, g1, f2 ):
+	return t * g1 * ( f1 + f2 )
+
 def getB( t, f1, g1, f2 ):
-	return float( t * g1 * ( f1 + f2 ) )
+	return float( getBArr( t, f1, g1, f2 ) )
+
+def getCArr( f1, g1 ):
+	return ( np.square( f1 ) + np.square( g1 ) ) / 4
 
 def getC( f1, g1 ):
-	return float( ( np.square( f1 ) + np.square( g1 ) ) / 4 )
+	return float( getCArr( f1, g1 ) )
 
 #############################################
 ########### Build Matrix Elements ###########
 #############################################
 
+def getMSquaredArr( s, t, u, A, B, C ):
+	return A - ( s - u ) * B + np.square( s - u ) * C
+
 def getMSquared( s, t, u, A, B, C ):
-	return float( A - ( s - u ) * B + np.square( s - u ) * C )
+	return float( getMSquaredArr( s, t, u, A, B, C ) )
 
 #############################################
 ########## Compute Differential CC ##########
 #############################################
 
-def getdCC( cos_theta_e, E_e, P_e, e, s, M ):
-	return float( 2 * m_p * P_e * e / ( 1 + e * ( 1 - E_e / P_e * cos_theta_e ) )
-	* np.square( g_f ) * np.square( cos_theta_c ) / ( 2 * np.pi * 
+def getdCCArr( cos_theta_e, E_e, P_e, e, s, M ):
+	return ( 2 * m_p * P_e * e / ( 1 + e * ( 1 - E_e / P_e * cos_theta_e ) )
+	* np.square( g_f ) * np.square( cos_theta_c ) / ( 2 * np.pi *
 	np.square( s - np.square( m_p ) ) ) * M )
 
+def getdCC( cos_theta_e, E_e, P_e, e, s, M ):
+	return float( getdCCArr( cos_theta_e, E_e, P_e, e, s, M ) )
+
+#############################################
+######### Batch Kinematics Engine ###########
+#############################################
+
+#Computes the full kinematic chain for arrays of neutrino energies and positron
+#angles in one numpy pass. E_v and cos_theta_e may be any broadcastable shapes
+#(e.g. a single energy against a grid of angles). Returns a dict of arrays keyed
+#by the eventTree branch names. All inputs must be above threshold.
+def getKinematics( E_v, cos_theta_e ):
+	E_v, cos_theta_e = np.broadcast_arrays( np.asarray( E_v, dtype=float ),
+	np.asarray( cos_theta_e, dtype=float ) )
+	e = epsilonArr( E_v )
+	E_e = posEnergyArr( E_v, cos_theta_e )
+	P_e = posMomentumArr( E_e )
+	E_n = ntronEnergyArr( E_v, E_e )
+	P_n = ntronMomentumArr( E_n )
+	cos_theta_n = ntronAngleArr( E_v, cos_theta_e, P_e, P_n )
+	s = getSArr( E_v )
+	t = getTArr( E_v, E_e, cos_theta_e, P_e )
+	u = getUArr( E_v, E_n, cos_theta_n, P_n )
+	f1 = getf1Arr( t )
+	f2 = getf2Arr( t )
+	g1 = getg1Arr( t )
+	A = getAArr( t, f1, g1, f2 )
+	B = getBArr( t, f1, g1, f2 )
+	C = getCArr( f1, g1 )
+	M = getMSquaredArr( s, t, u, A, B, C )
+	return { "E_v": E_v,
+		"E_e": E_e,
+		"E_n": E_n,
+		"cos_theta_e": cos_theta_e,
+		"cos_theta_n": cos_theta_n,
+		"dCC": getdCCArr( cos_theta_e, E_e, P_e, e, s, M ),
+		"openingAngle": openingAngle( cos_theta_e, cos_theta_n ) }
+
 #############################################	
 ###### Sample the reactor nu spectrum #######
 #############################################
 
+#Samplers already loaded, keyed by spectrum file name.
+samplers = {}
+
+#Load (once) the sampler for a spectrum file: root or npz from writeSpectra/spectrumBuilder,
+#or a time dependent source from supernovaSource.py.
+def getSampler( filename ):
+	if filename not in samplers:
+		if SupernovaSource.isSourceFile( filename ):
+			samplers[filename] = SupernovaSource.fromFile( filename )
+		else:
+			samplers[filename] = SpectrumSampler.fromTable( filename )
+	return samplers[filename]
+
+#Single energy, kept for compatibility. Use getSampler( filename ).sample( n ) for batches.
 def getEnergy( filename ):
-	f = ROOT.TFile( filename )
-	hist = f.Get("specHist")
-	return hist.GetRandom()
+	return float( getSampler( filename ).sample( 1 )[0] )
 
 ##############################################	
 #### Sample Positron Angular Distribution ####
@@ -204,115 +311,358 @@ def getEnergy( filename ):
 #May need to add a line seeding this to be fully rigorous.
 def getAngle():
 	return random.uniform(-1,1)
+
+#Batch version of getAngle, returns n positron angles. rng is a numpy Generator
+#(defaults to numpy's global state).
+def getAngles( n, rng=None ):
+	if rng is None:
+		return np.random.uniform( -1, 1, n )
+	return rng.uniform( -1, 1, n )
 	
 #############################################
 ######## Compute Total Cross Section ########
 #############################################
 
-def getCC( E_v ):
-	totCC = 0
-	for i in range( -numSamples / 2, numSamples / 2 ):
-		cos_theta_e = float( 2 * i / numSamples )
-		e = epsilon( E_v )
-		k = kappa( e, cos_theta_e )
-		E_e = posEnergy( E_v, cos_theta_e )
-		P_e = posMomentum( E_e )
-		E_n = ntronEnergy( E_v, E_e )
-		P_n = ntronMomentum( E_n )
-		cos_theta_n = ntronAngle( E_v, cos_theta_e, P_e, P_n )
-		angl = openingAngle( cos_theta_e, cos_theta_n )
-		s = getS( E_v )
-		t = getT( E_v, E_e, cos_theta_e, P_e )
-		u = getU( E_v, E_n, cos_theta_n, P_n )
-		f1 = getf1( t )
-		f2 = getf2( t )
-		g1 = getg1( t )
-		A = getA( t, f1, g1, f2 )
-		B = getB( t, f1, g1, f2 )
-		C = getC( f1, g1 )
-		M = getMSquared( s, t, u, A, B, C )
-		dCC = getdCC( cos_theta_e, E_e, P_e, e, s, M )
-		totCC += float( dCC * 3.89105e-22 * 2 / numSamples ) #differential cc * step size
+MeV2_to_cm2 = 3.89105e-22 #Converts cross sections from MeV^-2 to cm^2.
+
+#Angles used for the numerical integration over cos_theta_e.
+def getCCAngles( samples=None ):
+	if samples is None:
+		samples = numSamples
+	return 2.0 * np.arange( -( samples // 2 ), samples // 2 ) / samples
+
+#Total cross section in cm^2 by direct integration over the positron angle.
+#E_v may be a scalar or an array of energies (all above threshold), the angular
+#integral is done as one broadcast over an (energy x angle) grid.
+def getCC( E_v, samples=None ):
+	if samples is None:
+		samples = numSamples
+	cos_theta_e = getCCAngles( samples )
+	dCC = getKinematics( np.asarray( E_v, dtype=float )[..., None], cos_theta_e )["dCC"]
+	totCC = np.sum( dCC, axis=-1 ) * MeV2_to_cm2 * 2 / samples #differential cc * step size
+	if np.ndim( totCC ) == 0:
+		return float( totCC )
 	return totCC
 
+#############################################
+########### Event Generation Modes ##########
+#############################################
+
+#weighted   - E_v from the spectrum, cos_theta_e uniform, each event weighted by dCC.
+#unweighted - (E_v, cos_theta_e) drawn from flux x dCC with an envelope/alias table
+#             and accept-reject, every event has the same weight.
+#In both modes weight is in MeV^-2 and normalized so histograms filled with it
+#have the same expectation for the same number of requested events.
+generationModes = ( "weighted", "unweighted" )
+
+#Weighted events. sampler = SpectrumSampler or SupernovaSource (ignored if energy is given).
+#Events below threshold are dropped, so fewer than n may be returned.
+def generateWeighted( n, sampler=None, energy=None, rng=None ):
+	times = None
+	if energy is not None:
+		energies = np.full( n, float( energy ) )
+	elif getattr( sampler, "timed", False ):
+		#Time dependent source (supernovaSource.py), keep each neutrino's emission time as t.
+		times, energies = sampler.sampleTimed( n, rng )
+	else:
+		energies = sampler.sample( n, rng )
+	#Check that we're above IBD threshold.
+	above = energies > E_thr
+	energies = energies[above]
+	event = getKinematics( energies, getAngles( len( energies ), rng ) )
+	event["weight"] = event["dCC"]
+	if times is not None:
+		event["t"] = times[above]
+	return event
+
+#Draws unweighted (E_v, cos_theta_e) pairs from flux(E_v) x dCC(E_v, cos_theta_e).
+#The (E_v, cos_theta_e) plane above threshold is cut into cells (the spectrum
+#knots, each split into energySubdivisions, times cosBins). Each cell's envelope
+#is the largest flux x dCC on its corners times safety; a cell is chosen from an
+#alias table over envelope x area, a point is drawn uniformly inside it and kept
+#with probability f / envelope.
+class UnweightedSampler:
+	def __init__( self, sampler=None, energy=None, cosBins=50, energySubdivisions=4, safety=1.1 ):
+		self.sampler = sampler
+		self.energy = energy
+		self.safety = safety
+		self.cosEdges = np.linspace( -1, 1, cosBins + 1 )
+		self.violations = 0
+
+		if energy is not None:
+			#Fixed energy, a single degenerate energy cell of unit flux.
+			if energy <= E_thr:
+				raise ValueError( "Fixed energy must be above IBD threshold" )
+			self.energyEdges = np.array( [ energy, energy ], dtype=float )
+			self.cellSegment = np.zeros( 1, dtype=int )
+			fluxMax = np.ones( 1 )
+			fluxLow = fluxHigh = fluxMax
+			dE = np.ones( 1 )
+		else:
+			knots = sampler.knots
+			if knots[-1] <= E_thr:
+				raise ValueError( "Spectrum lies entirely below IBD threshold" )
+			first = np.searchsorted( knots, E_thr, side="right" )
+			#Knot intervals above threshold, the first one starts at threshold.
+			low = np.concatenate( ( [ E_thr ], knots[first:-1] ) )
+			high = knots[first:]
+			segment = np.arange( first - 1, len( knots ) - 1 )
+			frac = np.linspace( 0, 1, energySubdivisions + 1 )
+			edges = low[:, None] + ( high - low )[:, None] * frac[None, :]
+			self.energyEdges = np.concatenate( ( edges[:, :-1].ravel(), high[-1:] ) )
+			self.cellSegment = np.repeat( segment, energySubdivisions )
+			#Flux is linear inside a knot interval, so its extremes are at the cell ends.
+			fluxLow = sampler.pdf( self.energyEdges[:-1], self.cellSegment )
+			fluxHigh = sampler.pdf( self.energyEdges[1:], self.cellSegment )
+			fluxMax = np.maximum( fluxLow, fluxHigh )
+			dE = np.diff( self.energyEdges )
+
+		dCC = getKinematics( self.energyEdges[:, None], self.cosEdges[None, :] )["dCC"]
+		dCCMax = np.maximum( np.maximum( dCC[:-1, :-1], dCC[1:, :-1] ), np.maximum( dCC[:-1, 1:], dCC[1:, 1:] ) )
+		self.envelope = safety * fluxMax[:, None] * dCCMax
+		area = dE[:, None] * np.diff( self.cosEdges )[None, :]
+		self.cells = AliasTable( self.envelope * area )
+
+		#Integral of flux x dCC over the plane (corner average per cell). Dividing by the
+		#2 units of cos_theta_e gives the mean weight of the weighted mode per requested event.
+		cornerMean = 0.25 * ( fluxLow[:, None] * ( dCC[:-1, :-1] + dCC[:-1, 1:] )
+		+ fluxHigh[:, None] * ( dCC[1:, :-1] + dCC[1:, 1:] ) )
+		self.integral = float( np.sum( cornerMean * area ) )
+		self.weight = self.integral / 2.0
+		self.acceptance = self.integral / self.cells.total
+
+	#Flux density used as the target, unit flux for a fixed energy.
+	def flux( self, E_v, iE ):
+		if self.energy is not None:
+			return np.ones( len( E_v ) )
+		return self.sampler.pdf( E_v, self.cellSegment[iE] )
+
+	#Draw exactly n unweighted events, rng is a numpy Generator.
+	def sample( self, n, rng=None ):
+		if rng is None:
+			rng = np.random.default_rng()
+		accepted = []
+		remaining = n
+		while remaining > 0:
+			proposals = int( remaining / self.acceptance * 1.1 ) + 16
+			cell = self.cells.sample( proposals, rng )
+			iE, iC = np.unravel_index( cell, self.envelope.shape )
+			E_v = self.energyEdges[iE] + rng.random( proposals ) * ( self.energyEdges[iE + 1] - self.energyEdges[iE] )
+			cos_theta_e = self.cosEdges[iC] + rng.random( proposals ) * ( self.cosEdges[iC + 1] - self.cosEdges[iC] )
+			event = getKinematics( E_v, cos_theta_e )
+			f = self.flux( E_v, iE ) * event["dCC"]
+			envelope = self.envelope[iE, iC]
+			self.violations += int( np.count_nonzero( f > envelope ) )
+			keep = np.flatnonzero( rng.random( proposals ) * envelope < f )[:remaining]
+			accepted.append( { key: value[keep] for key, value in event.items() } )
+			remaining -= len( keep )
+		event = { key: np.concatenate( [ chunk[key] for chunk in accepted ] ) for key in accepted[0] }
+		event["weight"] = np.full( n, self.weight )
+		return event
+
 #############################################	
-############### Main Function ###############
+################ Run Settings ###############
 #############################################
 
-#Supply this with the name of the root file containing the spectrum and 
-#the number of IBD events to generate.
-def main():
-	#Initialize everything.
-	E_v = array( 'd', [0] )
-	E_e = array( 'd', [0] )
-	E_n = array( 'd', [0] )
-	cos_theta_e = array( 'd', [0] )
-	cos_theta_n = array( 'd', [0] )
-	dCC = array( 'd', [0] )
-	angl = array( 'd', [0] )
-
-	#Get run parameters from the user.
-	filename = input( "Enter the path to the neutrino spectrum .root file: " )
-	numEvents = int( input( "Enter the number of IBD events you wish to generate: " ) )
-	output = input( "Enter the path and name of the output file you wish to produce: " )
-	
-	#Set up root stuff.
-	eventFile = ROOT.TFile( output, "recreate" )
-	eventTree = ROOT.TTree( "eventTree", "IBD Event Tree" )
-	eventTree.Branch( "E_v", E_v, "E_v/D" )
-	eventTree.Branch( "E_e", E_e, "E_e/D" )
-	eventTree.Branch( "E_n", E_n, "E_n/D" )
-	eventTree.Branch( "cos_theta_e", cos_theta_e, "cos_theta_e/D" )
-	eventTree.Branch( "cos_theta_n", cos_theta_n, "cos_theta_n/D" )
-	eventTree.Branch( "dCC", dCC, "dCC/D" )
-	eventTree.Branch( "openingAngle", angl, "angl/D" )
-	posSpecHist = ROOT.TH1F("posSpecHist","Positron Spectrum",1000,0,100)
-	ntronSpecHist = ROOT.TH1F("ntronSpecHist","Neutron Spectrum",1000,0,5)
-	posAnglHist = ROOT.TH1F("posAnglHist","Positron Angular Distribution",100,-1,1)
-	ntronAnglHist = ROOT.TH1F("ntronAnglHist","Neutron Angular Distribution",50,0,1)
-	anglHist = ROOT.TH1F("anglHist","Opening Angle Distribution",1800,0,180)
-	ntronVposHist = ROOT.TH2F("ntronVposHist","Positron Energy vs. Neutron Energy",1000,0,2,1000,0,90)
-	
-	#Loop through generating events. tqdm gives a progress bar.
+#Number of events to push through the batch kinematics engine at once.
+chunkSize = 100000
+#Set to an energy in MeV to generate every event at that energy instead of sampling the spectrum.
+fixedEnergy = None
+#"weighted" or "unweighted", see Event Generation Modes.
+generationMode = "weighted"
+#"root" or "npz", see eventWriter.py.
+outputFormat = "root"
+#Worker processes, and shards handed out per worker (for load balancing).
+workers = 1
+shardsPerWorker = 4
+
+#############################################
+########## Seeded, Sharded Generation #######
+#############################################
+
+#Every chunk gets its own random stream derived from the master seed and the chunk
+#index, so the events do not depend on how chunks are split across workers: a run
+#with N workers is identical to a serial run with the same seed.
+def getChunkRng( seed, chunkIndex ):
+	return np.random.default_rng( np.random.SeedSequence( seed, spawn_key=( chunkIndex, ) ) )
+
+#The spectrum sampler for a run, None for fixed energy runs.
+def getSettingsSampler( settings ):
+	if settings["fixedEnergy"] is not None:
+		return None
+	sampler = settings.get( "sampler" )
+	if sampler is None:
+		sampler = getSampler( settings["filename"] )
+	return sampler
+
+#Branches written on top of eventWriter.branches (t for time dependent sources).
+def getExtraBranches( settings ):
+	if getattr( getSettingsSampler( settings ), "timed", False ):
+		return ( "t", )
+	return ()
+
+#Generate chunks [firstChunk, lastChunk) into writer. settings holds filename,
+#numEvents, seed, chunkSize, fixedEnergy and generationMode, and optionally a
+#ready-made SpectrumSampler as "sampler" (e.g. from reactorSpectrum.py) to use
+#instead of loading filename.
+#Returns ( events written, envelope violations ).
+def generateChunks( settings, firstChunk, lastChunk, writer, progress=False ):
+	sampler = getSettingsSampler( settings )
+	if settings["generationMode"] not in generationModes:
+		raise ValueError( "Unknown generation mode " + str( settings["generationMode"] ) )
+	if settings["generationMode"] == "unweighted":
+		if getattr( sampler, "timed", False ):
+			raise ValueError( "Time dependent sources only support weighted generation" )
+		unweighted = UnweightedSampler( sampler, settings["fixedEnergy"] )
+
 	ibdCount = 0
-	for i in tqdm( range( 0, numEvents ) ):
-		#E_v[0] = getEnergy( filename )
-		E_v[0] = 5.0;
-		#Check that we"re above IBD threshold.
-		if E_v[0] > E_thr:
-			cos_theta_e[0] = getAngle()
-			e = epsilon( E_v[0] )
-			k = kappa( e, cos_theta_e[0] )
-			E_e[0] = posEnergy( E_v[0], cos_theta_e[0] )
-			P_e = posMomentum( E_e[0] )
-			E_n[0] = ntronEnergy( E_v[0], E_e[0] )
-			P_n = ntronMomentum( E_n[0] )
-			cos_theta_n[0] = ntronAngle( E_v[0], cos_theta_e[0], P_e, P_n )
-			angl[0] = openingAngle( cos_theta_e[0], cos_theta_n[0] )
-			s = getS( E_v[0] )
-			t = getT( E_v[0], E_e[0], cos_theta_e[0], P_e )
-			u = getU( E_v[0], E_n[0], cos_theta_n[0], P_n )
-			f1 = getf1( t )
-			f2 = getf2( t )
-			g1 = getg1( t )
-			A = getA( t, f1, g1, f2 )
-			B = getB( t, f1, g1, f2 )
-			C = getC( f1, g1 )
-			M = getMSquared( s, t, u, A, B, C )
-			dCC[0] = getdCC( cos_theta_e[0], E_e[0], P_e, e, s, M )
-			eventTree.Fill()
-			posSpecHist.Fill( E_e[0] - m_e, dCC[0] )
-			ntronSpecHist.Fill( E_n[0] - m_n, dCC[0] )
-			posAnglHist.Fill( cos_theta_e[0], dCC[0] )
-			ntronAnglHist.Fill( cos_theta_n[0], dCC[0] )
-			anglHist.Fill( angl[0], dCC[0] )
-			ntronVposHist.Fill( E_n[0] - m_n, E_e[0] - m_e, dCC[0] )
-			ibdCount += 1
+	chunks = range( firstChunk, lastChunk )
+	if progress:
+		#tqdm gives a progress bar.
+		chunks = tqdm( chunks )
+	for chunk in chunks:
+		rng = getChunkRng( settings["seed"], chunk )
+		n = min( settings["chunkSize"], settings["numEvents"] - chunk * settings["chunkSize"] )
+		if settings["generationMode"] == "weighted":
+			event = generateWeighted( n, sampler, settings["fixedEnergy"], rng )
+		else:
+			event = unweighted.sample( n, rng )
+		writer.write( event )
+		ibdCount += len( event["E_v"] )
+
+	violations = 0
+	if settings["generationMode"] == "unweighted":
+		violations = unweighted.violations
+	return ibdCount, violations
+
+#Worker entry point, writes one shard as npz chunks into shardOutput.
+def runShard( args ):
+	settings, firstChunk, lastChunk, shardOutput = args
+	writer = EventWriter( shardOutput, "npz", getExtraBranches( settings ) )
+	result = generateChunks( settings, firstChunk, lastChunk, writer )
+	writer.close()
+	return result
+
+#Generate a full run into output. Shards are merged in chunk order, so the event
+#tree is the same for any number of workers.
+def generate( settings, output, outputFormat="root", numWorkers=1 ):
+	#Checked before the output is created, generateChunks would fail after truncating it.
+	if settings["generationMode"] == "unweighted" and getattr( getSettingsSampler( settings ), "timed", False ):
+		raise ValueError( "Time dependent sources only support weighted generation" )
+	numChunks = -( -settings["numEvents"] // settings["chunkSize"] )
+	writer = EventWriter( output, outputFormat, getExtraBranches( settings ) )
+	if numWorkers <= 1 or numChunks <= 1:
+		ibdCount, violations = generateChunks( settings, 0, numChunks, writer, progress=True )
+	else:
+		import multiprocessing
+		import shutil
+		shardDir = output + ".shards"
+		#Leftovers of a crashed run would be merged with this one.
+		shutil.rmtree( shardDir, ignore_errors=True )
+		bounds = np.linspace( 0, numChunks, min( numChunks, numWorkers * shardsPerWorker ) + 1 ).astype( int )
+		shards = [ ( settings, bounds[i], bounds[i + 1], os.path.join( shardDir, "shard_%05d" % i ) )
+			for i in range( len( bounds ) - 1 ) ]
+		pool = multiprocessing.Pool( numWorkers )
+		try:
+			results = list( tqdm( pool.imap( runShard, shards ), total=len( shards ) ) )
+		finally:
+			pool.close()
+			pool.join()
+		ibdCount = sum( r[0] for r in results )
+		violations = sum( r[1] for r in results )
+		for shard in shards:
+			writer.mergeShard( shard[3] )
+		shutil.rmtree( shardDir )
+	writer.close()
+	return ibdCount, violations
+
+#############################################	
+############### Main Function ###############
+#############################################
+
+#Command line / config file options. Every option can also be given in the [PyBD]
+#section of a config file passed with --config, command line values win. e.g.
+#	[PyBD]
+#	spectrum = reactorNuSpec.root
+#	events = 10000000
+#	output = reactor_1e7.root
+#	seed = 1
+#	workers = 8
+def getParser():
+	parser = argparse.ArgumentParser( description="Python based inverse beta decay event generator" )
+	parser.add_argument( "--config", help="config file with a [PyBD] section holding any of the options below" )
+	parser.add_argument( "--spectrum", help="neutrino spectrum file (specHist/specCDF, or a supernovaSource.py source)" )
+	parser.add_argument( "--events", type=int, help="number of neutrinos to generate" )
+	parser.add_argument( "--output", help="output file (root) or directory (npz)" )
+	parser.add_argument( "--seed", type=int, default=None, help="master random seed (random if not given)" )
+	parser.add_argument( "--chunk-size", type=int, default=chunkSize, help="events per chunk" )
+	parser.add_argument( "--workers", type=int, default=workers, help="number of worker processes" )
+	parser.add_argument( "--format", choices=outputFormats, default=outputFormat, help="output format" )
+	parser.add_argument( "--mode", choices=generationModes, default=generationMode, help="generation mode" )
+	parser.add_argument( "--energy", type=float, default=fixedEnergy,
+	help="generate every event at this neutrino energy (MeV) instead of sampling the spectrum" )
+	return parser
+
+#Parse the command line, filling defaults from --config first.
+def getArgs( argv=None ):
+	parser = getParser()
+	known, rest = parser.parse_known_args( argv )
+	if known.config is not None:
+		config = configparser.ConfigParser()
+		if not config.read( known.config ):
+			parser.error( "cannot read config file " + known.config )
+		if not config.has_section( "PyBD" ):
+			parser.error( known.config + " has no [PyBD] section" )
+		#Option names in the file may use - or _ (chunk-size or chunk_size).
+		dests = { action.dest for action in parser._actions }
+		defaults = {}
+		for key, value in config.items( "PyBD" ):
+			dest = key.replace( "-", "_" )
+			if dest not in dests:
+				parser.error( "unknown option " + key + " in " + known.config )
+			defaults[dest] = value
+		#String defaults are converted with each option's type by argparse.
+		parser.set_defaults( **defaults )
+	args = parser.parse_args( argv )
+	#argparse only checks choices on the command line, not on config file defaults.
+	for action in parser._actions:
+		if action.choices is not None and getattr( args, action.dest ) not in action.choices:
+			parser.error( "invalid " + action.dest + " " + repr( getattr( args, action.dest ) ) + " in " + str( known.config )
+				+ " (choose from " + ", ".join( action.choices ) + ")" )
+
+	#Missing run parameters are asked for when run interactively.
+	prompts = ( ( "spectrum", "Enter the path to the neutrino spectrum .root file: " ),
+		( "events", "Enter the number of IBD events you wish to generate: " ),
+		( "output", "Enter the path and name of the output file you wish to produce: " ) )
+	for dest, prompt in prompts:
+		if getattr( args, dest ) is None:
+			if dest == "spectrum" and args.energy is not None:
+				continue
+			if not sys.stdin.isatty():
+				parser.error( "--" + dest + " is required" )
+			value = input( prompt )
+			setattr( args, dest, int( value ) if dest == "events" else value )
+	if args.mode == "unweighted" and args.energy is None and SupernovaSource.isSourceFile( args.spectrum ):
+		parser.error( "time dependent sources (" + args.spectrum + ") only support --mode weighted" )
+	return args
+
+def main( argv=None ):
+	args = getArgs( argv )
+
+	#Pick (and report) a master seed so any run can be repeated exactly.
+	seed = args.seed
+	if seed is None:
+		seed = np.random.SeedSequence().entropy
+	print( "Master seed: " + str( seed ) )
+
+	settings = { "filename": args.spectrum, "numEvents": args.events, "seed": seed, "chunkSize": args.chunk_size,
+		"fixedEnergy": args.energy, "generationMode": args.mode }
+	ibdCount, violations = generate( settings, args.output, args.format, args.workers )
 			
-	#Report the number of neutrinos above threshold and write our file.
-	print str( ibdCount ) + " neutrinos out of " + str( numEvents ) + " above threshold."
-	eventFile.Write()
-	eventFile.Close()
+	#Report the number of neutrinos above threshold.
+	print( str( ibdCount ) + " neutrinos out of " + str( args.events ) + " above threshold." )
+	if violations > 0:
+		print( "Warning: envelope exceeded " + str( violations ) + " times, increase safety." )
 
 #Execute main function 	
 if __name__== "__main__":
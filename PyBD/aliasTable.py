@@ -0,0 +1,44 @@
+# Walker alias table for drawing indices from a fixed discrete distribution in
+# O(1) per draw. Used by PyBD to pick envelope cells for unweighted generation.
+#
+# Usage:
+#	table = AliasTable( weights )
+#	indices = table.sample( n, rng ) # rng is a numpy Generator
+
+import numpy as np
+
+class AliasTable:
+	# weights = non-negative weights of any shape, indices returned are into the
+	# flattened array (use np.unravel_index for the original shape).
+	def __init__( self, weights ):
+		weights = np.asarray( weights, dtype=float ).ravel()
+		if np.any( weights < 0 ) or not np.sum( weights ) > 0:
+			raise ValueError( "Alias table needs non-negative weights with a positive sum" )
+		self.size = len( weights )
+		self.total = float( np.sum( weights ) )
+		scaled = weights * self.size / self.total
+		self.prob = np.ones( self.size )
+		self.alias = np.arange( self.size )
+
+		# Pair every under-full cell with an over-full one (Vose's method).
+		small = list( np.flatnonzero( scaled < 1.0 ) )
+		large = list( np.flatnonzero( scaled >= 1.0 ) )
+		while small and large:
+			s = small.pop()
+			l = large.pop()
+			self.prob[s] = scaled[s]
+			self.alias[s] = l
+			scaled[l] -= 1.0 - scaled[s]
+			if scaled[l] < 1.0:
+				small.append( l )
+			else:
+				large.append( l )
+		# Whatever is left is full up to rounding.
+		for i in small + large:
+			self.prob[i] = 1.0
+
+	# Draw n indices.
+	def sample( self, n, rng ):
+		cell = rng.integers( 0, self.size, n )
+		keep = rng.random( n ) < self.prob[cell]
+		return np.where( keep, cell, self.alias[cell] )
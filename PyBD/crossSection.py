@@ -0,0 +1,136 @@
+# Tabulated IBD total cross section for PyBD.
+#
+# getCC( E_v ) integrates the differential cross section over numSamples positron
+# angles every time it is called. For flux-weighted rates over a spectrum that is
+# far too slow, so this module builds sigma(E_v) once on an energy grid (one
+# broadcast over energy x angle), caches it to disk and serves lookups by
+# interpolation.
+#
+# Usage:
+#	import crossSection
+#	table = crossSection.getCCTable()
+#	sigma = table( energies ) # cm^2, 0 below threshold
+#
+# Accuracy (default grid, 2000 points from E_thr to 100 MeV, numSamples = 1000):
+#	Interpolation error is checked against the direct getCC integral at every
+#	grid midpoint when the table is built and stored as table.maxRelError.
+#	The default grid is quadratically spaced (dense near threshold) because
+#	sigma turns on steeply there; an evenly spaced grid of the same size is
+#	off by ~20% in its first bin.
+#	"linear" : max relative error < 1e-3 (8.0e-4 next to threshold, < 1.1e-5 above 2 MeV)
+#	"spline" : max relative error < 2e-6 (< 4e-10 above 2 MeV)
+
+import os
+import hashlib
+import numpy as np
+import PyBD as ibd
+
+# Default energy grid in MeV.
+E_min = ibd.E_thr
+E_max = 100.0
+nPoints = 2000
+spacing = "quadratic" # "quadratic" (dense near threshold) or "linear"
+
+# Tables are cached here, one file per set of physics constants and grid.
+cacheDir = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "ccTables" )
+
+# Energies per block when building, keeps the (energy x angle) grid small in memory.
+buildBlockSize = 200
+
+# Hash of every constant that enters the cross section, plus the grid and
+# integration settings, used to name the cache file.
+def getCacheKey( energies, samples ):
+	constants = ( ibd.cos_theta_c, ibd.g_f, ibd.m_p, ibd.m_n, ibd.m_e, ibd.m_A,
+	ibd.m_V, ibd.g0, ibd.m, ibd.m_pi, ibd.D, ibd.ksi, ibd.MeV2_to_cm2, samples )
+	digest = hashlib.sha1( repr( constants ).encode() )
+	digest.update( np.ascontiguousarray( energies, dtype=float ).tobytes() )
+	return digest.hexdigest()[:16]
+
+# Direct integral over an array of energies, done in blocks.
+def computeCC( energies, samples ):
+	energies = np.asarray( energies, dtype=float )
+	sigma = np.empty( len( energies ) )
+	for first in range( 0, len( energies ), buildBlockSize ):
+		sigma[first:first + buildBlockSize] = ibd.getCC( energies[first:first + buildBlockSize], samples )
+	return sigma
+
+class CrossSectionTable:
+	# energies = grid in MeV (must start at or above E_thr)
+	# samples = number of angles in the direct integral, defaults to PyBD.numSamples
+	# method = "linear" or "spline"
+	# useCache = read/write the table in cacheDir
+	def __init__( self, energies, samples=None, method="linear", useCache=True ):
+		if samples is None:
+			samples = ibd.numSamples
+		if method not in ( "linear", "spline" ):
+			raise ValueError( "Unknown interpolation method " + str( method ) )
+		self.energies = np.asarray( energies, dtype=float )
+		if self.energies[0] < ibd.E_thr or np.any( np.diff( self.energies ) <= 0 ):
+			raise ValueError( "Energy grid must be increasing and start at or above E_thr" )
+		self.samples = samples
+		self.method = method
+		self.key = getCacheKey( self.energies, samples )
+
+		cacheFile = os.path.join( cacheDir, "ccTable_" + self.key + ".npz" )
+		if useCache and os.path.exists( cacheFile ):
+			cached = np.load( cacheFile )
+			self.sigma = cached["sigma"]
+			midSigma = cached["midSigma"]
+		else:
+			self.sigma = computeCC( self.energies, samples )
+			midSigma = computeCC( self.getMidpoints(), samples )
+			if useCache:
+				if not os.path.isdir( cacheDir ):
+					os.makedirs( cacheDir )
+				np.savez( cacheFile, energies=self.energies, sigma=self.sigma, midSigma=midSigma )
+
+		if method == "spline":
+			from scipy.interpolate import CubicSpline
+			self.spline = CubicSpline( self.energies, self.sigma )
+
+		# Worst relative interpolation error at the grid midpoints, where it peaks.
+		self.maxRelError = float( np.max( np.abs( self.interpolate( self.getMidpoints() ) - midSigma ) / midSigma ) )
+
+	def getMidpoints( self ):
+		return 0.5 * ( self.energies[1:] + self.energies[:-1] )
+
+	# Interpolate inside the grid, no threshold handling.
+	def interpolate( self, E_v ):
+		if self.method == "spline":
+			return self.spline( E_v )
+		return np.interp( E_v, self.energies, self.sigma )
+
+	# Total cross section in cm^2 for a scalar or array of energies.
+	# Returns 0 below threshold, raises ValueError above the table range.
+	def __call__( self, E_v ):
+		E_v = np.asarray( E_v, dtype=float )
+		if np.any( E_v > self.energies[-1] ):
+			raise ValueError( "Energy above cross section table range ( " + str( self.energies[-1] ) + " MeV )" )
+		sigma = np.where( E_v >= self.energies[0], self.interpolate( np.clip( E_v, self.energies[0], None ) ), 0.0 )
+		if sigma.ndim == 0:
+			return float( sigma )
+		return sigma
+
+# Tables already built in this process, keyed by cache key and method.
+tables = {}
+
+# Energy grid from eMin to eMax, see spacing above.
+def getEnergyGrid( eMin, eMax, points, gridSpacing=spacing ):
+	u = np.linspace( 0, 1, points )
+	if gridSpacing == "quadratic":
+		u = np.square( u )
+	elif gridSpacing != "linear":
+		raise ValueError( "Unknown grid spacing " + str( gridSpacing ) )
+	return eMin + ( eMax - eMin ) * u
+
+# Get a (possibly cached) table.
+def getCCTable( eMin=None, eMax=E_max, points=nPoints, gridSpacing=spacing, samples=None, method="linear", useCache=True ):
+	if eMin is None:
+		eMin = E_min
+	if samples is None:
+		samples = ibd.numSamples
+	energies = getEnergyGrid( eMin, eMax, points, gridSpacing )
+	key = ( getCacheKey( energies, samples ), method )
+	if key not in tables:
+		tables[key] = CrossSectionTable( energies, samples, method, useCache )
+	return tables[key]
@@ -0,0 +1,130 @@
+# Chunked output stage for PyBD.
+#
+# Events arrive as dicts of numpy arrays (one chunk from getKinematics / the
+# generation modes). Each chunk is appended to the event tree in one bulk write
+# and histogrammed with numpy, so output cost is paid per chunk, not per event.
+#
+# Formats:
+#	"root" - eventTree plus the histograms in one ROOT file, written with uproot
+#	"npz"  - a directory holding one eventTree_NNNNN.npz per chunk plus hists.npz
+#	         (chunk and histogram files already in the directory are replaced)
+#
+# Usage:
+#	writer = EventWriter( "reactor.root", "root" )
+#	writer.write( event ) # once per chunk
+#	writer.close()
+
+import os
+import glob
+import numpy as np
+from histograms import Histogram
+from treeReader import getChunkFiles
+
+m_e = 0.5109989 # Electron mass in MeV/c^2
+m_n = 939.56536 # Neutron mass in MeV/c^2
+
+outputFormats = ( "root", "npz" )
+
+# eventTree branches in output order.
+branches = ( "E_v", "E_e", "E_n", "cos_theta_e", "cos_theta_n", "dCC", "openingAngle", "weight" )
+# Optional branches a generator may add after those (e.g. t, the neutrino emission
+# time from a supernovaSource).
+optionalBranches = ( "t", )
+
+# The standard PyBD histograms, all weighted by the event weight.
+def makeHistograms():
+	return [ Histogram( "posSpecHist", "Positron Spectrum", [ ( 1000, 0, 100 ) ] ),
+		Histogram( "ntronSpecHist", "Neutron Spectrum", [ ( 1000, 0, 5 ) ] ),
+		Histogram( "posAnglHist", "Positron Angular Distribution", [ ( 100, -1, 1 ) ] ),
+		Histogram( "ntronAnglHist", "Neutron Angular Distribution", [ ( 50, 0, 1 ) ] ),
+		Histogram( "anglHist", "Opening Angle Distribution", [ ( 1800, 0, 180 ) ] ),
+		Histogram( "ntronVposHist", "Positron Energy vs. Neutron Energy", [ ( 1000, 0, 2 ), ( 1000, 0, 90 ) ] ) ]
+
+# Fill the standard histograms from one chunk of events.
+def fillHistograms( hists, event ):
+	hists = { hist.name: hist for hist in hists }
+	weight = event["weight"]
+	T_e = event["E_e"] - m_e
+	T_n = event["E_n"] - m_n
+	hists["posSpecHist"].fill( T_e, weights=weight )
+	hists["ntronSpecHist"].fill( T_n, weights=weight )
+	hists["posAnglHist"].fill( event["cos_theta_e"], weights=weight )
+	hists["ntronAnglHist"].fill( event["cos_theta_n"], weights=weight )
+	hists["anglHist"].fill( event["openingAngle"], weights=weight )
+	hists["ntronVposHist"].fill( T_n, T_e, weights=weight )
+
+# Histograms from an npz output's hists.npz, keyed by name.
+def readHistograms( filename ):
+	hists = {}
+	with np.load( filename ) as arrays:
+		for key in arrays.files:
+			name, field = key.split( "/" )
+			hists.setdefault( name, {} )[field] = arrays[key]
+	return { name: Histogram.fromArrays( name, fields ) for name, fields in hists.items() }
+
+class EventWriter:
+	# extraBranches = optionalBranches every chunk will carry.
+	def __init__( self, output, outputFormat="root", extraBranches=() ):
+		if outputFormat not in outputFormats:
+			raise ValueError( "Unknown output format " + str( outputFormat ) )
+		for name in extraBranches:
+			if name not in optionalBranches:
+				raise ValueError( "Unknown branch " + str( name ) )
+		self.output = output
+		self.outputFormat = outputFormat
+		self.branches = branches + tuple( extraBranches )
+		self.hists = makeHistograms()
+		self.numChunks = 0
+		self.numEvents = 0
+		if outputFormat == "root":
+			import uproot
+			self.file = uproot.recreate( output )
+			self.tree = self.file.mktree( "eventTree", { name: np.float64 for name in self.branches }, title="IBD Event Tree" )
+		else:
+			if not os.path.isdir( output ):
+				os.makedirs( output )
+			# Remove the files of an earlier run in the same directory, they would be
+			# read back as part of this one.
+			for oldFile in glob.glob( os.path.join( output, "eventTree_*.npz" ) ) + glob.glob( os.path.join( output, "hists.npz" ) ):
+				os.remove( oldFile )
+
+	# Append one chunk (dict of equal length arrays with at least the branches above
+	# and the extra branches).
+	def write( self, event ):
+		if len( event["E_v"] ) == 0:
+			return
+		self.writeColumns( event )
+		fillHistograms( self.hists, event )
+
+	# Append one chunk to the event tree only.
+	def writeColumns( self, event ):
+		columns = { name: np.ascontiguousarray( event[name], dtype=np.float64 ) for name in self.branches }
+		if self.outputFormat == "root":
+			self.tree.extend( columns )
+		else:
+			np.savez( os.path.join( self.output, "eventTree_%05d.npz" % self.numChunks ), **columns )
+		self.numChunks += 1
+		self.numEvents += len( columns["E_v"] )
+
+	# Append a finished npz shard (e.g. from a worker process): its tree chunks
+	# in order, and its histograms added to ours.
+	def mergeShard( self, shardOutput ):
+		for chunkFile in getChunkFiles( shardOutput ):
+			with np.load( chunkFile ) as chunk:
+				self.writeColumns( { name: chunk[name] for name in self.branches } )
+		shardHists = readHistograms( os.path.join( shardOutput, "hists.npz" ) )
+		for hist in self.hists:
+			hist.add( shardHists[hist.name] )
+
+	# Write the histograms and close the output.
+	def close( self ):
+		if self.outputFormat == "root":
+			for hist in self.hists:
+				self.file[hist.name] = hist.toWritable()
+			self.file.close()
+		else:
+			arrays = {}
+			for hist in self.hists:
+				for key, value in hist.toArrays().items():
+					arrays[hist.name + "/" + key] = value
+			np.savez( os.path.join( self.output, "hists.npz" ), **arrays )
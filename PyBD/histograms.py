@@ -0,0 +1,124 @@
+# Numpy-backed fixed-bin histograms (1D, 2D or 3D) for PyBD output.
+#
+# Filling a ROOT TH1 per event from Python costs more than generating the event,
+# so PyBD accumulates whole chunks at once with numpy.bincount and converts to a
+# ROOT TH1F/TH2F/TH3F only when the file is written. Under/overflow bins and the
+# weighted statistics (sumw, sumw2, sumwx, ...) are kept the same way ROOT does.
+#
+# Usage:
+#	hist = Histogram( "posSpecHist", "Positron Spectrum", [ ( 1000, 0, 100 ) ] )
+#	hist.fill( energies, weights=dCC )
+#	outFile["posSpecHist"] = hist.toWritable() # uproot file
+
+import numpy as np
+
+class Histogram:
+	# axes = list of ( nBins, low, high ), one per dimension (x, y, z).
+	def __init__( self, name, title, axes ):
+		if not 1 <= len( axes ) <= 3:
+			raise ValueError( "Histograms must have 1 to 3 axes" )
+		self.name = name
+		self.title = title
+		self.axes = [ ( int( nBins ), float( low ), float( high ) ) for nBins, low, high in axes ]
+		# Bin contents including under/overflow, stored as [x, y, z] like ROOT's global bins.
+		shape = tuple( nBins + 2 for nBins, low, high in self.axes )
+		self.sumw = np.zeros( shape )
+		self.sumw2 = np.zeros( shape )
+		self.entries = 0
+		# Sums of w, w^2, w*x_i, w*x_i^2 and w*x_i*x_j over in-range entries.
+		dims = len( self.axes )
+		self.stats = { "w": 0.0, "w2": 0.0, "x": np.zeros( dims ), "x2": np.zeros( dims ), "xy": np.zeros( ( dims, dims ) ) }
+
+	# Bin index (0 = underflow, nBins + 1 = overflow) along one axis.
+	def binIndex( self, axis, values ):
+		nBins, low, high = self.axes[axis]
+		# Same arithmetic as TAxis::FindFixBin, clipped before the int cast so +-inf are safe.
+		index = np.floor( nBins * ( values - low ) / ( high - low ) )
+		return np.clip( index, -1, nBins ).astype( np.int64 ) + 1
+
+	# Fill with arrays of coordinates (one per axis) and optional weights.
+	def fill( self, *coords, weights=None ):
+		if len( coords ) != len( self.axes ):
+			raise ValueError( self.name + " needs " + str( len( self.axes ) ) + " coordinate arrays" )
+		coords = [ np.asarray( c, dtype=float ).ravel() for c in coords ]
+		if weights is None:
+			weights = np.ones( len( coords[0] ) )
+		else:
+			weights = np.broadcast_to( np.asarray( weights, dtype=float ), coords[0].shape )
+		# ROOT skips NaN coordinates entirely.
+		good = np.all( [ ~np.isnan( c ) for c in coords ], axis=0 )
+		if not np.all( good ):
+			coords = [ c[good] for c in coords ]
+			weights = weights[good]
+		if len( weights ) == 0:
+			return
+
+		index = [ self.binIndex( axis, c ) for axis, c in enumerate( coords ) ]
+		flat = np.ravel_multi_index( index, self.sumw.shape )
+		self.sumw += np.bincount( flat, weights, self.sumw.size ).reshape( self.sumw.shape )
+		self.sumw2 += np.bincount( flat, np.square( weights ), self.sumw.size ).reshape( self.sumw.shape )
+		self.entries += len( weights )
+
+		inRange = np.all( [ ( i > 0 ) & ( i <= self.axes[axis][0] ) for axis, i in enumerate( index ) ], axis=0 )
+		w = weights[inRange]
+		x = np.array( [ c[inRange] for c in coords ] )
+		self.stats["w"] += float( np.sum( w ) )
+		self.stats["w2"] += float( np.sum( np.square( w ) ) )
+		self.stats["x"] += x @ w
+		self.stats["x2"] += np.square( x ) @ w
+		self.stats["xy"] += ( x * w ) @ x.T
+
+	# Add another histogram with identical binning (e.g. from another worker).
+	def add( self, other ):
+		if other.axes != self.axes:
+			raise ValueError( "Cannot add histograms with different binning: " + self.name )
+		self.sumw += other.sumw
+		self.sumw2 += other.sumw2
+		self.entries += other.entries
+		for key in self.stats:
+			self.stats[key] = self.stats[key] + other.stats[key]
+
+	# Bin edges along one axis.
+	def edges( self, axis=0 ):
+		nBins, low, high = self.axes[axis]
+		return np.linspace( low, high, nBins + 1 )
+
+	# Contents without under/overflow, indexed [x, y, z].
+	def values( self ):
+		return self.sumw[ tuple( slice( 1, -1 ) for axis in self.axes ) ]
+
+	# Plain arrays for npz output, see fromArrays.
+	def toArrays( self ):
+		return { "title": np.array( self.title ), "axes": np.array( self.axes ), "sumw": self.sumw,
+			"sumw2": self.sumw2, "entries": np.array( self.entries ),
+			"stats_w": np.array( [ self.stats["w"], self.stats["w2"] ] ), "stats_x": self.stats["x"],
+			"stats_x2": self.stats["x2"], "stats_xy": self.stats["xy"] }
+
+	@classmethod
+	def fromArrays( cls, name, arrays ):
+		hist = cls( name, str( arrays["title"] ), [ tuple( a ) for a in arrays["axes"] ] )
+		hist.sumw = np.array( arrays["sumw"] )
+		hist.sumw2 = np.array( arrays["sumw2"] )
+		hist.entries = int( arrays["entries"] )
+		hist.stats = { "w": float( arrays["stats_w"][0] ), "w2": float( arrays["stats_w"][1] ),
+			"x": np.array( arrays["stats_x"] ), "x2": np.array( arrays["stats_x2"] ), "xy": np.array( arrays["stats_xy"] ) }
+		return hist
+
+	# uproot object for a TH1F/TH2F/TH3F (TH1D/TH2D/TH3D with double=True), write
+	# with outFile[name] = hist.toWritable().
+	def toWritable( self, double=False ):
+		from uproot.writing.identify import to_TArray, to_TH1x, to_TH2x, to_TH3x, to_TAxis
+		axisNames = ( "xaxis", "yaxis", "zaxis" )
+		axes = [ to_TAxis( axisNames[i], "", nBins, low, high ) for i, ( nBins, low, high ) in enumerate( self.axes ) ]
+		# ROOT stores the global bins with x running fastest.
+		data = to_TArray( self.sumw.T.ravel().astype( np.float64 if double else np.float32 ) )
+		sumw2 = to_TArray( self.sumw2.T.ravel() )
+		s = self.stats
+		common = ( self.name, self.title, data, float( self.entries ), s["w"], s["w2"] )
+		if len( self.axes ) == 1:
+			return to_TH1x( *common, s["x"][0], s["x2"][0], sumw2, axes[0] )
+		if len( self.axes ) == 2:
+			return to_TH2x( *common, s["x"][0], s["x2"][0], s["x"][1], s["x2"][1], s["xy"][0, 1],
+				sumw2, axes[0], axes[1] )
+		return to_TH3x( *common, s["x"][0], s["x2"][0], s["x"][1], s["x2"][1], s["xy"][0, 1],
+			s["x"][2], s["x2"][2], s["xy"][0, 2], s["xy"][1, 2], sumw2, axes[0], axes[1], axes[2] )
@@ -0,0 +1,112 @@
+# Vectorized neutron ray tracing through a stack of finite-thickness panels.
+#
+# PostProcess.getNtronTOF treats the panels as infinitely thin planes. Here each
+# panel is an axis-aligned box and a whole batch of neutrons is traced against
+# every panel at once (slab method), giving entry/exit distances, path lengths,
+# the first panel hit after leaving the source and the probability of the
+# neutron interacting in each panel.
+#
+# Coordinates (same as PostProcess): z is along the neutrino axis, normal to the
+# panels; x (horizontal) and y (vertical) are across the panel face. A neutron
+# with polar angle theta (from z) and azimuth phi moves along
+#	( sin(theta) sin(phi), sin(theta) cos(phi), cos(theta) ).
+#
+# Usage:
+#	stack = PanelStack.regular( numPanels=3, separation=30.0, thickness=5.0, height=30.0 )
+#	trace = stack.trace( origins, directions, interactionLength=10.0 )
+#	trace["firstHit"], trace["firstHitDistance"], trace["captureProbability"]
+
+import numpy as np
+
+# Unit direction vectors (n x 3) from polar angle theta and azimuth phi in radians.
+def getDirections( theta, phi ):
+	sinTheta = np.sin( theta )
+	return np.column_stack( ( sinTheta * np.sin( phi ), sinTheta * np.cos( phi ), np.cos( theta ) ) )
+
+class PanelStack:
+	# lower, upper = ( numPanels x 3 ) box corners in cm, ( x, y, z ) per panel.
+	def __init__( self, lower, upper ):
+		self.lower = np.atleast_2d( np.asarray( lower, dtype=float ) )
+		self.upper = np.atleast_2d( np.asarray( upper, dtype=float ) )
+		if self.lower.shape != self.upper.shape or self.lower.shape[1] != 3:
+			raise ValueError( "Panel corners must be ( numPanels x 3 ) arrays of equal shape" )
+		if np.any( self.upper < self.lower ):
+			raise ValueError( "Panel upper corners must not be below the lower corners" )
+		self.numPanels = len( self.lower )
+
+	# numPanels identical square panels of side height, fronts spaced by separation
+	# along z starting at z = 0 (panel 0 is the one the IBD happens in).
+	@classmethod
+	def regular( cls, numPanels, separation, thickness, height, width=None ):
+		if width is None:
+			width = height
+		if thickness > separation:
+			raise ValueError( "Panels thicker than their separation would overlap" )
+		front = separation * np.arange( numPanels )
+		lower = np.column_stack( ( np.zeros( numPanels ), np.zeros( numPanels ), front ) )
+		upper = np.column_stack( ( np.full( numPanels, width ), np.full( numPanels, height ), front + thickness ) )
+		return cls( lower, upper )
+
+	# Distances along each ray to the entry and exit of every panel, ( n x numPanels ).
+	# Rays that miss a panel get entry = +inf, exit = -inf. Entry is clipped at 0 for
+	# rays starting inside a panel.
+	def intersect( self, origins, directions ):
+		origins = np.asarray( origins, dtype=float )[:, None, :]
+		directions = np.asarray( directions, dtype=float )[:, None, :]
+		with np.errstate( divide="ignore", invalid="ignore" ):
+			t1 = ( self.lower[None] - origins ) / directions
+			t2 = ( self.upper[None] - origins ) / directions
+		near = np.minimum( t1, t2 )
+		far = np.maximum( t1, t2 )
+		# A ray parallel to a slab is inside it for all t or never.
+		parallel = directions == 0
+		insideSlab = ( origins >= self.lower[None] ) & ( origins <= self.upper[None] )
+		near = np.where( parallel, np.where( insideSlab, -np.inf, np.inf ), near )
+		far = np.where( parallel, np.where( insideSlab, np.inf, -np.inf ), far )
+		entry = np.maximum( np.max( near, axis=2 ), 0.0 )
+		leave = np.min( far, axis=2 )
+		hit = leave >= entry
+		return np.where( hit, entry, np.inf ), np.where( hit, leave, -np.inf )
+
+	# Trace a batch of rays.
+	# origins, directions = ( n x 3 ), directions must be unit vectors
+	# sourcePanel = panel the rays start in, never counted as the first hit (None for none)
+	# interactionLength = mean free path in cm (scalar or one per panel), None for
+	#   geometry only
+	# velocity = neutron speed in cm/ns (array or scalar) to also get firstHitTOF
+	# Returns a dict of arrays:
+	#	entry, exit, pathLength     ( n x numPanels ), path length 0 for misses
+	#	firstHit                    index of the first panel entered (excluding the source), -1 if none
+	#	firstHitDistance            distance to its entry face, nan if none
+	#	firstHitTOF                 firstHitDistance / velocity in ns, nan if none
+	#	captureProbability          ( n x numPanels ) probability to interact in each panel,
+	#	                            accounting for attenuation in panels crossed earlier
+	def trace( self, origins, directions, sourcePanel=0, interactionLength=None, velocity=None ):
+		entry, leave = self.intersect( origins, directions )
+		pathLength = np.where( np.isfinite( entry ), leave - entry, 0.0 )
+		trace = { "entry": entry, "exit": leave, "pathLength": pathLength }
+
+		candidates = entry
+		if sourcePanel is not None:
+			candidates = entry.copy()
+			candidates[:, sourcePanel] = np.inf
+		firstHit = np.argmin( candidates, axis=1 )
+		firstHitDistance = candidates[ np.arange( len( candidates ) ), firstHit ]
+		missed = ~np.isfinite( firstHitDistance )
+		trace["firstHit"] = np.where( missed, -1, firstHit )
+		trace["firstHitDistance"] = np.where( missed, np.nan, firstHitDistance )
+		if velocity is not None:
+			trace["firstHitTOF"] = trace["firstHitDistance"] / velocity
+
+		if interactionLength is not None:
+			lengths = np.broadcast_to( np.asarray( interactionLength, dtype=float ), ( self.numPanels, ) )
+			opticalDepth = pathLength / lengths[None, :]
+			# Order panels along each ray, accumulate attenuation from the ones crossed before.
+			order = np.argsort( entry, axis=1 )
+			sortedDepth = np.take_along_axis( opticalDepth, order, axis=1 )
+			before = np.cumsum( sortedDepth, axis=1 ) - sortedDepth
+			sortedCapture = np.exp( -before ) * -np.expm1( -sortedDepth )
+			capture = np.empty_like( sortedCapture )
+			np.put_along_axis( capture, order, sortedCapture, axis=1 )
+			trace["captureProbability"] = capture
+		return trace
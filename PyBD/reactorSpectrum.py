@@ -0,0 +1,132 @@
+# Fission-fraction weighted, time-dependent reactor antineutrino spectra.
+#
+# writeSpectra.writeReactorSpectrum only gives the Klapdor U235 curve. A power
+# reactor burns U235, U238, Pu239 and Pu241, with the plutonium share growing
+# over the fuel cycle. Here each isotope's spectrum is tabulated once per binning
+# (memoized in isotopeTables) and the combined spectra for all time steps come
+# out of one matrix product ( nTimes x 4 fractions ) @ ( 4 x nBins tables ).
+# Every time step can be handed to PyBD as a SpectrumSampler without writing a
+# spectrum file, and ( time step, energy ) pairs for a whole cycle can be drawn
+# in bulk.
+#
+# Usage:
+#	import reactorSpectrum
+#	times = np.linspace( 0, 1, 13 ) # fraction of the fuel cycle
+#	spectrum = reactorSpectrum.ReactorSpectrum( times )
+#	settings["sampler"] = spectrum.getSampler( 6 ) # PyBD.generate, mid-cycle
+#	timeIndex, energies = spectrum.sample( 1000000, rng )
+#
+# Isotope spectra are the exp-polynomial fits of Mueller et al. 2011,
+# N(E) = exp( sum_k a_k E^k ) in antineutrinos per fission per MeV, fitted from
+# 2 to 8 MeV and extrapolated outside.
+
+import numpy as np
+from spectrumSampler import SpectrumSampler
+
+isotopes = ( "U235", "U238", "Pu239", "Pu241" )
+
+# Mueller et al. 2011 fit coefficients a_0 ... a_5 (E in MeV).
+coefficients = {
+	"U235": ( 3.217, -3.111, 1.395, -3.690e-1, 4.445e-2, -2.053e-3 ),
+	"U238": ( 4.833e-1, 1.927e-1, -1.283e-1, -6.762e-3, 2.233e-3, -1.536e-4 ),
+	"Pu239": ( 6.413, -7.432, 3.535, -8.820e-1, 1.025e-1, -4.550e-3 ),
+	"Pu241": ( 3.251, -3.204, 1.428, -3.675e-1, 4.254e-2, -1.896e-3 ) }
+
+# Rough PWR fission fractions ( U235, U238, Pu239, Pu241 ) at the start and end
+# of a fuel cycle (time 0 and 1). Pass the reactor's own burnup table for real runs.
+cycleTimes = ( 0.0, 1.0 )
+cycleFractions = ( ( 0.68, 0.07, 0.22, 0.03 ), ( 0.46, 0.08, 0.37, 0.09 ) )
+
+# Default binning in MeV, from the IBD threshold up.
+E_min = 1.8
+E_max = 10.0
+nBins = 1000
+
+# Evaluations averaged per bin when tabulating an isotope.
+samplesPerBin = 16
+
+# Isotope spectrum at energies E (any shape) in antineutrinos per fission per MeV.
+def getIsotopeSpectrum( isotope, E ):
+	return np.exp( np.polynomial.polynomial.polyval( np.asarray( E, dtype=float ), coefficients[isotope] ) )
+
+# Tables already built, keyed by the bin edges.
+isotopeTables = {}
+
+# ( 4 x nBins ) mean spectrum of each isotope over each bin, rows in isotopes order.
+def getIsotopeTables( edges ):
+	edges = np.asarray( edges, dtype=float )
+	key = ( edges.tobytes(), samplesPerBin )
+	if key not in isotopeTables:
+		offsets = ( np.arange( samplesPerBin ) + 0.5 ) / samplesPerBin
+		points = edges[:-1, None] + np.diff( edges )[:, None] * offsets[None, :]
+		isotopeTables[key] = np.array( [ np.mean( getIsotopeSpectrum( isotope, points ), axis=1 ) for isotope in isotopes ] )
+	return isotopeTables[key]
+
+# ( nTimes x 4 ) fission fractions at times, linearly interpolated in a burnup
+# table ( times, one row of fractions per time ), constant beyond its ends.
+def getFissionFractions( times, tableTimes=cycleTimes, tableFractions=cycleFractions ):
+	times = np.atleast_1d( np.asarray( times, dtype=float ) )
+	tableFractions = np.asarray( tableFractions, dtype=float )
+	return np.column_stack( [ np.interp( times, tableTimes, tableFractions[:, i] ) for i in range( len( isotopes ) ) ] )
+
+# ( nTimes x nBins ) combined spectra per fission (times fissionRates, one per time
+# step, if given) for a ( nTimes x 4 ) array of fission fractions.
+def getSpectra( fractions, edges, fissionRates=None ):
+	spectra = np.atleast_2d( np.asarray( fractions, dtype=float ) ) @ getIsotopeTables( edges )
+	if fissionRates is not None:
+		spectra = spectra * np.asarray( fissionRates, dtype=float ).reshape( -1, 1 )
+	return spectra
+
+class ReactorSpectrum:
+	# times = time steps (in the units of the burnup table)
+	# fractions = ( nTimes x 4 ) fission fractions, None to interpolate the burnup table
+	# edges = bin edges in MeV, None for the default binning
+	# fissionRates = relative fission rate per time step (e.g. thermal power), None for constant
+	def __init__( self, times, fractions=None, edges=None, fissionRates=None, tableTimes=cycleTimes, tableFractions=cycleFractions ):
+		self.times = np.atleast_1d( np.asarray( times, dtype=float ) )
+		if fractions is None:
+			fractions = getFissionFractions( self.times, tableTimes, tableFractions )
+		self.fractions = np.atleast_2d( np.asarray( fractions, dtype=float ) )
+		if self.fractions.shape != ( len( self.times ), len( isotopes ) ):
+			raise ValueError( "Need one row of " + str( len( isotopes ) ) + " fission fractions per time step" )
+		if edges is None:
+			edges = np.linspace( E_min, E_max, nBins + 1 )
+		self.edges = np.asarray( edges, dtype=float )
+		self.spectra = getSpectra( self.fractions, self.edges, fissionRates )
+		# Neutrinos per time step, and each time step's cumulative table.
+		binWidths = np.diff( self.edges )
+		self.totals = self.spectra @ binWidths
+		cdf = np.cumsum( self.spectra * binWidths, axis=1 ) / self.totals[:, None]
+		self.cdf = np.concatenate( ( np.zeros( ( len( self.times ), 1 ) ), cdf ), axis=1 )
+
+	# Sampler for one time step, to pass to PyBD as settings["sampler"].
+	def getSampler( self, timeIndex, interpolation="flat", seed=None ):
+		return SpectrumSampler( self.edges, self.spectra[timeIndex], interpolation, seed )
+
+	# Sampler for the whole cycle (time steps weighted by their neutrino output).
+	def getAverageSampler( self, interpolation="flat", seed=None ):
+		return SpectrumSampler( self.edges, np.sum( self.spectra, axis=0 ), interpolation, seed )
+
+	# Energies for events at the given time step indices, uniform within bins. All
+	# time steps are inverted at once: row t of the cdf table is shifted up by t,
+	# so one searchsorted over the flattened table finds every event's bin.
+	def sampleEnergies( self, timeIndex, rng ):
+		timeIndex = np.asarray( timeIndex )
+		numEdges = len( self.edges )
+		shifted = ( self.cdf + np.arange( len( self.times ) )[:, None] ).ravel()
+		u = rng.random( timeIndex.shape )
+		position = np.searchsorted( shifted, timeIndex + u, side="right" ) - 1
+		# Stay inside the event's own row (bin 0 ... nBins - 1).
+		segment = np.clip( position - timeIndex * numEdges, 0, numEdges - 2 )
+		flat = self.cdf.ravel()
+		low = flat[timeIndex * numEdges + segment]
+		high = flat[timeIndex * numEdges + segment + 1]
+		with np.errstate( divide="ignore", invalid="ignore" ):
+			x = np.where( high > low, ( u - low ) / ( high - low ), 0.5 )
+		return self.edges[segment] + np.clip( x, 0, 1 ) * np.diff( self.edges )[segment]
+
+	# n ( time step index, energy ) pairs over the whole cycle.
+	def sample( self, n, rng ):
+		timeIndex = np.searchsorted( np.cumsum( self.totals ) / np.sum( self.totals ), rng.random( n ), side="right" )
+		timeIndex = np.minimum( timeIndex, len( self.times ) - 1 )
+		return timeIndex, self.sampleEnergies( timeIndex, rng )
@@ -0,0 +1,132 @@
+# Build binned neutrino spectra from tabulated points.
+#
+# writeSpectra.py used to evaluate a TGraph 10000 times in a Python loop and
+# Fill a TH1D point by point. Here the tabulated points are read from a data
+# file (see spectrumData/), interpolated on the whole sub-bin grid in one numpy
+# call and the histogram is written together with its cumulative table, so a
+# fine-binned spectrum for a large production takes milliseconds and can be
+# sampled directly with SpectrumSampler.fromTable.
+#
+# Usage:
+#	python spectrumBuilder.py spectrumData/klapdor1982_U235.csv reactorNuSpec.root --low 1 --high 9 --bins 10000
+#
+#	import spectrumBuilder
+#	energies, values = spectrumBuilder.loadPoints( "spectrumData/klapdor1982_U235.csv" )
+#	spectrumBuilder.writeSpectrum( "reactorNuSpec.root", *spectrumBuilder.buildSpectrum( energies, values, 1, 9, 10000 ) )
+#
+# methods:
+#	"linear"    - straight lines between the points (what TGraph::Eval did)
+#	"loglinear" - straight lines in log(value), better for steeply falling spectra
+#	"spline"    - cubic spline through the points (needs scipy), clipped at 0
+# The spectrum is 0 outside the tabulated range.
+#
+# Bin contents are the mean of the spectrum over each bin (value units, e.g.
+# 1/MeV/fission), the same normalization writeSpectra.py always produced.
+
+import os
+import argparse
+import numpy as np
+from histograms import Histogram
+
+methods = ( "linear", "loglinear", "spline" )
+
+# Directory holding the tabulated spectra shipped with PyBD.
+dataDir = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "spectrumData" )
+
+# Tabulated ( energies, values ) from a text file with two columns, comma or
+# whitespace separated (e.g. DataThief csv output). Lines starting with # are
+# comments. Points are returned sorted by energy.
+def loadPoints( filename ):
+	with open( filename ) as f:
+		lines = [ line for line in f if line.strip() and not line.lstrip().startswith( "#" ) ]
+	delimiter = "," if "," in lines[0] else None
+	points = np.loadtxt( lines, delimiter=delimiter, ndmin=2 )
+	if points.shape[1] < 2 or len( points ) < 2:
+		raise ValueError( "Need at least two ( energy, value ) points in " + filename )
+	order = np.argsort( points[:, 0], kind="stable" )
+	return points[order, 0], points[order, 1]
+
+# Evaluate the tabulated spectrum at energies E (any shape).
+def interpolate( energies, values, E, method="linear" ):
+	if method not in methods:
+		raise ValueError( "Unknown interpolation method " + str( method ) )
+	energies = np.asarray( energies, dtype=float )
+	values = np.asarray( values, dtype=float )
+	E = np.asarray( E, dtype=float )
+	if method == "linear":
+		result = np.interp( E, energies, values )
+	elif method == "loglinear":
+		# Empty points are taken as the smallest positive float so the log stays finite.
+		logValues = np.log( np.clip( values, np.finfo( float ).tiny, None ) )
+		result = np.exp( np.interp( E, energies, logValues ) )
+	else:
+		from scipy.interpolate import CubicSpline
+		result = np.clip( CubicSpline( energies, values )( E ), 0, None )
+	inside = ( E >= energies[0] ) & ( E <= energies[-1] )
+	return np.where( inside, result, 0.0 )
+
+# Bin edges and contents of the spectrum on nBins even bins from low to high.
+# Each bin content is the average of samplesPerBin evaluations at evenly spaced
+# points inside the bin.
+def buildSpectrum( energies, values, low, high, nBins, method="linear", samplesPerBin=16 ):
+	edges = np.linspace( low, high, nBins + 1 )
+	offsets = ( np.arange( samplesPerBin ) + 0.5 ) / samplesPerBin
+	points = edges[:-1, None] + np.diff( edges )[:, None] * offsets[None, :]
+	contents = np.mean( interpolate( energies, values, points, method ), axis=1 )
+	return edges, contents
+
+# Cumulative table of a binned spectrum: cdf[i] is the fraction of the spectrum
+# below edges[i]. Negative contents count as empty, as in SpectrumSampler.
+def getCDF( contents ):
+	cdf = np.concatenate( ( [0.0], np.cumsum( np.clip( contents, 0, None ) ) ) )
+	if not cdf[-1] > 0:
+		raise ValueError( "Spectrum has no positive bin contents" )
+	return cdf / cdf[-1]
+
+# Write the spectrum as specHist (TH1D) plus the specCDF tree (branches energy and
+# cdf, one entry per bin edge) to a ROOT file, or the same arrays to an npz file
+# when output ends in .npz.
+def writeSpectrum( output, edges, contents, title="Neutrino Spectrum" ):
+	edges = np.asarray( edges, dtype=float )
+	contents = np.asarray( contents, dtype=float )
+	cdf = getCDF( contents )
+	if output.endswith( ".npz" ):
+		np.savez( output, edges=edges, contents=contents, cdf=cdf )
+		return
+	import uproot
+	hist = Histogram( "specHist", title, [ ( len( contents ), edges[0], edges[-1] ) ] )
+	# Every bin gets exactly its content, with the stats ROOT would have from one
+	# fill per bin center.
+	centers = 0.5 * ( edges[1:] + edges[:-1] )
+	hist.fill( centers, weights=contents )
+	with uproot.recreate( output ) as f:
+		f["specHist"] = hist.toWritable( double=True )
+		f.mktree( "specCDF", { "energy": np.float64, "cdf": np.float64 }, title="Spectrum CDF" )
+		f["specCDF"].extend( { "energy": edges, "cdf": cdf } )
+
+# Load points, build and write in one step.
+def buildSpectrumFile( pointsFile, output, low, high, nBins, method="linear", samplesPerBin=16, title="Neutrino Spectrum" ):
+	energies, values = loadPoints( pointsFile )
+	edges, contents = buildSpectrum( energies, values, low, high, nBins, method, samplesPerBin )
+	writeSpectrum( output, edges, contents, title )
+	return edges, contents
+
+def getParser():
+	parser = argparse.ArgumentParser( description="Build a binned neutrino spectrum from tabulated points" )
+	parser.add_argument( "points", help="Text file of ( energy in MeV, value ) points" )
+	parser.add_argument( "output", help="Output file (.root, or .npz for numpy arrays)" )
+	parser.add_argument( "--low", type=float, required=True, help="Lower spectrum edge in MeV" )
+	parser.add_argument( "--high", type=float, required=True, help="Upper spectrum edge in MeV" )
+	parser.add_argument( "--bins", type=int, default=1000, help="Number of bins" )
+	parser.add_argument( "--method", choices=methods, default="linear", help="Interpolation between the points" )
+	parser.add_argument( "--samples-per-bin", type=int, default=16, help="Evaluations averaged per bin" )
+	parser.add_argument( "--title", default="Neutrino Spectrum", help="Histogram title" )
+	return parser
+
+def main( argv=None ):
+	args = getParser().parse_args( argv )
+	buildSpectrumFile( args.points, args.output, args.low, args.high, args.bins, args.method,
+		args.samples_per_bin, args.title )
+
+if __name__== "__main__":
+	main()
@@ -0,0 +1,134 @@
+# Fast neutrino energy sampling for PyBD.
+#
+# getEnergy( filename ) used to open the spectrum file and call TH1::GetRandom
+# for every event. SpectrumSampler loads specHist once, builds its cumulative
+# table and draws any number of energies with a single vectorized inverse-CDF
+# call, so spectra from writeSpectra.py can be sampled at millions of events per
+# second.
+#
+# Usage:
+#	import spectrumSampler
+#	sampler = spectrumSampler.SpectrumSampler.fromRootFile( "reactorNuSpec.root", seed=1 )
+#	energies = sampler.sample( 1000000 )
+#
+# Spectra built with spectrumBuilder.py also carry their cumulative table and
+# load without PyROOT through SpectrumSampler.fromTable.
+#
+# interpolation:
+#	"flat"   - uniform within each bin, the same distribution as TH1::GetRandom
+#	"linear" - piecewise linear density through the bin centers (flat out to the
+#	           outer edges), removes the staircase of coarse spectra
+
+import numpy as np
+
+class SpectrumSampler:
+	# edges = bin edges (nBins + 1), contents = bin contents (nBins), negative
+	# contents are treated as empty bins.
+	def __init__( self, edges, contents, interpolation="flat", seed=None ):
+		self.edges = np.asarray( edges, dtype=float )
+		self.contents = np.clip( np.asarray( contents, dtype=float ), 0, None )
+		if len( self.edges ) != len( self.contents ) + 1:
+			raise ValueError( "Need one more bin edge than bin content" )
+		if not np.sum( self.contents ) > 0:
+			raise ValueError( "Spectrum has no positive bin contents" )
+		if interpolation not in ( "flat", "linear" ):
+			raise ValueError( "Unknown interpolation " + str( interpolation ) )
+		self.interpolation = interpolation
+		self.rng = np.random.default_rng( seed )
+
+		if interpolation == "flat":
+			# Knots are the bin edges, density constant in each bin.
+			self.knots = self.edges
+			mass = self.contents
+			self.slopes = np.zeros( len( mass ) )
+			self.density = mass / np.diff( self.edges )
+		else:
+			# Knots at the outer edges and every bin center, density linear between them.
+			centers = 0.5 * ( self.edges[1:] + self.edges[:-1] )
+			binDensity = self.contents / np.diff( self.edges )
+			self.knots = np.concatenate( ( self.edges[:1], centers, self.edges[-1:] ) )
+			knotDensity = np.concatenate( ( binDensity[:1], binDensity, binDensity[-1:] ) )
+			width = np.diff( self.knots )
+			self.density = knotDensity[:-1]
+			self.slopes = np.diff( knotDensity ) / width
+			mass = 0.5 * ( knotDensity[:-1] + knotDensity[1:] ) * width
+
+		# Cumulative table, cdf[i] is the probability below knot i.
+		self.cdf = np.concatenate( ( [0.0], np.cumsum( mass ) ) )
+		self.norm = self.cdf[-1]
+		self.cdf /= self.norm
+
+	# Build a sampler from a TH1 in a root file (specHist by default).
+	@classmethod
+	def fromRootFile( cls, filename, histName="specHist", interpolation="flat", seed=None ):
+		import ROOT
+		f = ROOT.TFile( filename )
+		hist = f.Get( histName )
+		if not hist:
+			raise IOError( "No histogram " + histName + " in " + filename )
+		nBins = hist.GetNbinsX()
+		axis = hist.GetXaxis()
+		edges = [ axis.GetBinLowEdge( i ) for i in range( 1, nBins + 2 ) ]
+		contents = [ hist.GetBinContent( i ) for i in range( 1, nBins + 1 ) ]
+		f.Close()
+		return cls( edges, contents, interpolation, seed )
+
+	# Build a sampler from a spectrumBuilder.py output: the specCDF table of a root
+	# file (read with uproot, so no PyROOT needed), falling back to its specHist,
+	# or the arrays of an npz file.
+	@classmethod
+	def fromTable( cls, filename, interpolation="flat", seed=None ):
+		if filename.endswith( ".npz" ):
+			with np.load( filename ) as arrays:
+				return cls( arrays["edges"], np.diff( arrays["cdf"] ), interpolation, seed )
+		import uproot
+		with uproot.open( filename ) as f:
+			if "specCDF" in f:
+				table = f["specCDF"].arrays( [ "energy", "cdf" ], library="np" )
+				return cls( table["energy"], np.diff( table["cdf"] ), interpolation, seed )
+			if "specHist" not in f:
+				raise IOError( "No specCDF or specHist in " + filename )
+			contents, edges = f["specHist"].to_numpy()
+			return cls( edges, contents, interpolation, seed )
+
+	# Map uniform numbers in [0,1) onto energies.
+	def inverseCDF( self, u ):
+		u = np.asarray( u, dtype=float )
+		segment = np.clip( np.searchsorted( self.cdf, u, side="right" ) - 1, 0, len( self.knots ) - 2 )
+		# Mass left to cover inside the chosen segment, in density units.
+		r = ( u - self.cdf[segment] ) * self.norm
+		f0 = self.density[segment]
+		s = self.slopes[segment]
+		# Solve f0 * x + s / 2 * x^2 = r for the offset x, written so s = 0 is exact.
+		root = np.sqrt( np.clip( np.square( f0 ) + 2 * s * r, 0, None ) )
+		with np.errstate( divide="ignore", invalid="ignore" ):
+			x = np.where( f0 + root > 0, 2 * r / ( f0 + root ), 0.0 )
+		return np.minimum( self.knots[segment] + x, self.knots[segment + 1] )
+
+	# Draw n energies, rng defaults to the sampler's own generator.
+	def sample( self, n, rng=None ):
+		if rng is None:
+			rng = self.rng
+		return self.inverseCDF( rng.random( n ) )
+
+	# Normalized density of the sampled distribution at E (0 outside the spectrum).
+	# segment picks which knot interval to evaluate in, so a value on a knot can be
+	# taken from either side; by default it is looked up from E.
+	def pdf( self, E, segment=None ):
+		E = np.asarray( E, dtype=float )
+		if segment is None:
+			segment = np.searchsorted( self.knots, E, side="right" ) - 1
+		inside = ( segment >= 0 ) & ( segment < len( self.knots ) - 1 )
+		segment = np.clip( segment, 0, len( self.knots ) - 2 )
+		density = self.density[segment] + self.slopes[segment] * ( E - self.knots[segment] )
+		return np.where( inside, density / self.norm, 0.0 )
+
+	# Mean of the sampled distribution, handy for sanity checks.
+	def mean( self ):
+		x0 = self.knots[:-1]
+		w = np.diff( self.knots )
+		f0 = self.density
+		s = self.slopes
+		# Integral of x * ( f0 + s * ( x - x0 ) ) over each segment.
+		moment = f0 * w * ( x0 + w / 2 ) + s * ( x0 * np.square( w ) / 2 + np.power( w, 3 ) / 3 )
+		return float( np.sum( moment ) / self.norm )
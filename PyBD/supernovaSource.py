@@ -0,0 +1,165 @@
+# Time and energy dependent supernova neutrino source for PyBD.
+#
+# writeSNSpectrum makes one time-integrated spectrum. Here the flux is built on a
+# ( time x energy ) grid from several spectra taken at different times after
+# bounce (time slices, e.g. DataThief csv files of published figures): each
+# slice is interpolated in energy (spectrumBuilder methods), slices are
+# interpolated linearly in time, and the cells go into one alias table over the
+# whole plane. PyBD then draws ( t, E_v ) pairs in bulk, with t written to the
+# event tree, so generated events carry realistic burst timing.
+#
+# Usage:
+#	python supernovaSource.py slices.txt snSource.npz --time-bins 200 --energy-bins 540
+#	python PyBD.py --spectrum snSource.npz --events 1000000 --output sn.root
+#
+#	source = SupernovaSource.fromSlices( [ 0.0, 0.1, 1.0 ], [ "t0.csv", "t0p1.csv", "t1.csv" ], timeEdges, energyEdges )
+#	t, E_v = source.sampleTimed( 1000000, rng )
+#
+# slices.txt lists one time slice per line: time in s, csv file of ( E_v in MeV,
+# flux ) points (paths relative to slices.txt). The flux is per unit time and
+# energy in any consistent units; it is 0 outside the slice times and energies.
+
+import os
+import argparse
+import numpy as np
+import spectrumBuilder
+from aliasTable import AliasTable
+from histograms import Histogram
+
+# Evaluations averaged per cell along each axis when gridding the slices.
+samplesPerBin = 4
+
+# Read a slice list file, returns ( times, csv paths ) sorted by time.
+def loadSliceList( filename ):
+	directory = os.path.dirname( os.path.abspath( filename ) )
+	times, files = [], []
+	with open( filename ) as f:
+		for line in f:
+			line = line.strip()
+			if not line or line.startswith( "#" ):
+				continue
+			time, path = [ field.strip() for field in line.split( ",", 1 ) ]
+			times.append( float( time ) )
+			files.append( os.path.join( directory, path ) )
+	if len( times ) < 2:
+		raise ValueError( "Need at least two time slices in " + filename )
+	order = np.argsort( times, kind="stable" )
+	return np.array( times )[order], [ files[i] for i in order ]
+
+# ( nTimeBins x nEnergyBins ) mean flux over each cell from time slices.
+# times = slice times (increasing), slices = one ( energies, values ) pair per slice.
+def gridSlices( times, slices, timeEdges, energyEdges, method="linear" ):
+	times = np.asarray( times, dtype=float )
+	offsets = ( np.arange( samplesPerBin ) + 0.5 ) / samplesPerBin
+	energyPoints = ( energyEdges[:-1, None] + np.diff( energyEdges )[:, None] * offsets[None, :] ).ravel()
+	timePoints = ( timeEdges[:-1, None] + np.diff( timeEdges )[:, None] * offsets[None, :] ).ravel()
+	# Every slice on the energy sub-grid, ( nSlices x nEnergyPoints ).
+	sliceFlux = np.array( [ spectrumBuilder.interpolate( energies, values, energyPoints, method ) for energies, values in slices ] )
+	# Linear interpolation in time between the bracketing slices.
+	upper = np.clip( np.searchsorted( times, timePoints, side="right" ), 1, len( times ) - 1 )
+	fraction = np.clip( ( timePoints - times[upper - 1] ) / ( times[upper] - times[upper - 1] ), 0, 1 )
+	flux = ( 1 - fraction )[:, None] * sliceFlux[upper - 1] + fraction[:, None] * sliceFlux[upper]
+	flux[ ( timePoints < times[0] ) | ( timePoints > times[-1] ) ] = 0.0
+	# Average the sub-samples of each cell.
+	flux = flux.reshape( len( timeEdges ) - 1, samplesPerBin, len( energyEdges ) - 1, samplesPerBin )
+	return flux.mean( axis=( 1, 3 ) )
+
+class SupernovaSource:
+	# Tells PyBD this source draws ( t, E_v ) pairs, see PyBD.generateWeighted.
+	timed = True
+
+	# timeEdges (s), energyEdges (MeV), contents = ( nTimeBins x nEnergyBins ) flux
+	# per unit time and energy, negative contents count as empty.
+	# seed = seed of the source's own generator, used when sampling without an rng.
+	def __init__( self, timeEdges, energyEdges, contents, seed=None ):
+		self.timeEdges = np.asarray( timeEdges, dtype=float )
+		self.energyEdges = np.asarray( energyEdges, dtype=float )
+		self.contents = np.clip( np.asarray( contents, dtype=float ), 0, None )
+		if self.contents.shape != ( len( self.timeEdges ) - 1, len( self.energyEdges ) - 1 ):
+			raise ValueError( "Source contents must be ( nTimeBins x nEnergyBins )" )
+		area = np.diff( self.timeEdges )[:, None] * np.diff( self.energyEdges )[None, :]
+		self.cells = AliasTable( self.contents * area )
+		# Number of neutrinos in the source, in the units of contents x s x MeV.
+		self.total = self.cells.total
+		self.rng = np.random.default_rng( seed )
+
+	@classmethod
+	def fromSlices( cls, times, files, timeEdges, energyEdges, method="linear", seed=None ):
+		slices = [ spectrumBuilder.loadPoints( filename ) for filename in files ]
+		timeEdges = np.asarray( timeEdges, dtype=float )
+		energyEdges = np.asarray( energyEdges, dtype=float )
+		return cls( timeEdges, energyEdges, gridSlices( times, slices, timeEdges, energyEdges, method ), seed )
+
+	# True if filename holds a source written by save (root or npz).
+	@staticmethod
+	def isSourceFile( filename ):
+		if filename.endswith( ".npz" ):
+			with np.load( filename ) as arrays:
+				return "timeEdges" in arrays.files
+		import uproot
+		with uproot.open( filename ) as f:
+			return "snHist" in f
+
+	@classmethod
+	def fromFile( cls, filename, seed=None ):
+		if filename.endswith( ".npz" ):
+			with np.load( filename ) as arrays:
+				return cls( arrays["timeEdges"], arrays["energyEdges"], arrays["contents"], seed )
+		import uproot
+		with uproot.open( filename ) as f:
+			contents, timeEdges, energyEdges = f["snHist"].to_numpy()
+		return cls( timeEdges, energyEdges, contents, seed )
+
+	# Write the grid as the snHist TH2D (time x energy) to a root file, or as arrays
+	# to an npz file. root output needs evenly spaced edges.
+	def save( self, output ):
+		if output.endswith( ".npz" ):
+			np.savez( output, timeEdges=self.timeEdges, energyEdges=self.energyEdges, contents=self.contents )
+			return
+		import uproot
+		hist = Histogram( "snHist", "Supernova Neutrino Flux;t (s);E_{#nu} (MeV)", [
+			( len( self.timeEdges ) - 1, self.timeEdges[0], self.timeEdges[-1] ),
+			( len( self.energyEdges ) - 1, self.energyEdges[0], self.energyEdges[-1] ) ] )
+		timeCenters = 0.5 * ( self.timeEdges[1:] + self.timeEdges[:-1] )
+		energyCenters = 0.5 * ( self.energyEdges[1:] + self.energyEdges[:-1] )
+		t, E = np.meshgrid( timeCenters, energyCenters, indexing="ij" )
+		hist.fill( t, E, weights=self.contents.ravel() )
+		with uproot.recreate( output ) as f:
+			f["snHist"] = hist.toWritable( double=True )
+
+	# Draw n ( t, E_v ) pairs: a cell from the alias table, then uniform inside it.
+	# rng defaults to the source's own generator.
+	def sampleTimed( self, n, rng=None ):
+		if rng is None:
+			rng = self.rng
+		cell = self.cells.sample( n, rng )
+		iT, iE = np.unravel_index( cell, self.contents.shape )
+		t = self.timeEdges[iT] + rng.random( n ) * np.diff( self.timeEdges )[iT]
+		E = self.energyEdges[iE] + rng.random( n ) * np.diff( self.energyEdges )[iE]
+		return t, E
+
+	# Energies only (time-integrated spectrum), same interface as SpectrumSampler.
+	def sample( self, n, rng=None ):
+		return self.sampleTimed( n, rng )[1]
+
+def getParser():
+	parser = argparse.ArgumentParser( description="Build a time and energy dependent supernova source from time slices" )
+	parser.add_argument( "slices", help="Slice list file, lines of: time in s, csv file" )
+	parser.add_argument( "output", help="Output file (.npz, or .root for the snHist TH2D)" )
+	parser.add_argument( "--time-bins", type=int, default=200, help="Number of time bins between the first and last slice" )
+	parser.add_argument( "--energy-low", type=float, default=0.0, help="Lower energy edge in MeV" )
+	parser.add_argument( "--energy-high", type=float, default=60.0, help="Upper energy edge in MeV" )
+	parser.add_argument( "--energy-bins", type=int, default=600, help="Number of energy bins" )
+	parser.add_argument( "--method", choices=spectrumBuilder.methods, default="linear", help="Interpolation in energy" )
+	return parser
+
+def main( argv=None ):
+	args = getParser().parse_args( argv )
+	times, files = loadSliceList( args.slices )
+	timeEdges = np.linspace( times[0], times[-1], args.time_bins + 1 )
+	energyEdges = np.linspace( args.energy_low, args.energy_high, args.energy_bins + 1 )
+	source = SupernovaSource.fromSlices( times, files, timeEdges, energyEdges, args.method )
+	source.save( args.output )
+
+if __name__== "__main__":
+	main()
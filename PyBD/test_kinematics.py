@@ -0,0 +1,48 @@
+# Checks that the batch kinematics engine (getKinematics) agrees with the scalar
+# per-event chain ( posEnergy ... getdCC, ntronAngle ) to floating-point tolerance.
+#
+# Usage:
+#	python -m pytest test_kinematics.py
+#	python test_kinematics.py
+
+import numpy as np
+import PyBD as ibd
+
+numPoints = 2000
+
+# Kinematics of one ( E_v, cos_theta_e ) point through the scalar functions.
+def getScalarKinematics( E_v, cos_theta_e ):
+	e = ibd.epsilon( E_v )
+	E_e = ibd.posEnergy( E_v, cos_theta_e )
+	P_e = ibd.posMomentum( E_e )
+	E_n = ibd.ntronEnergy( E_v, E_e )
+	P_n = ibd.ntronMomentum( E_n )
+	cos_theta_n = ibd.ntronAngle( E_v, cos_theta_e, P_e, P_n )
+	s = ibd.getS( E_v )
+	t = ibd.getT( E_v, E_e, cos_theta_e, P_e )
+	u = ibd.getU( E_v, E_n, cos_theta_n, P_n )
+	f1 = ibd.getf1( t )
+	f2 = ibd.getf2( t )
+	g1 = ibd.getg1( t )
+	A = ibd.getA( t, f1, g1, f2 )
+	B = ibd.getB( t, f1, g1, f2 )
+	C = ibd.getC( f1, g1 )
+	M = ibd.getMSquared( s, t, u, A, B, C )
+	return { "E_e": E_e,
+		"E_n": E_n,
+		"cos_theta_n": cos_theta_n,
+		"dCC": ibd.getdCC( cos_theta_e, E_e, P_e, e, s, M ),
+		"openingAngle": ibd.openingAngle( cos_theta_e, cos_theta_n ) }
+
+def test_kinematics():
+	rng = np.random.default_rng( 1 )
+	E_v = rng.uniform( ibd.E_thr, 100.0, numPoints )
+	cos_theta_e = rng.uniform( -1.0, 1.0, numPoints )
+	batch = ibd.getKinematics( E_v, cos_theta_e )
+	scalar = [ getScalarKinematics( E, c ) for E, c in zip( E_v, cos_theta_e ) ]
+	for name in ( "dCC", "E_e", "E_n", "cos_theta_n", "openingAngle" ):
+		np.testing.assert_allclose( batch[name], [ point[name] for point in scalar ], rtol=1e-12, atol=0, err_msg=name )
+
+if __name__== "__main__":
+	test_kinematics()
+	print( "Batch and scalar kinematics agree on " + str( numPoints ) + " points." )
@@ -0,0 +1,75 @@
+# Streaming reader for PyBD event trees.
+#
+# Yields the tree in fixed-size chunks of numpy columns (dict of branch name ->
+# array), so post-processing stages can run over trees larger than memory at
+# bulk-read speed instead of SetBranchAddress + GetEntry per entry.
+#
+# Works on ROOT files (read with uproot) and on PyBD's npz output directories
+# (eventTree_NNNNN.npz chunk files, see eventWriter.py).
+#
+# Usage:
+#	for events in iterateTree( "reactor_1e6.root", branches=[ "E_n", "cos_theta_n" ], chunkSize=100000 ):
+#		...
+
+import os
+import glob
+import numpy as np
+
+# Number of entries in the tree.
+def getNumEntries( filename, treeName="eventTree" ):
+	filename = os.path.expanduser( filename )
+	if os.path.isdir( filename ):
+		total = 0
+		for chunkFile in getChunkFiles( filename ):
+			with np.load( chunkFile ) as chunk:
+				total += len( chunk[ chunk.files[0] ] )
+		return total
+	import uproot
+	with uproot.open( filename ) as f:
+		return f[treeName].num_entries
+
+# Chunk files of an npz output directory in chunk order. Sorted by the chunk number,
+# not by name, since the number outgrows its zero padding past 99999 chunks.
+def getChunkFiles( directory ):
+	chunkFiles = glob.glob( os.path.join( directory, "eventTree_*.npz" ) )
+	return sorted( chunkFiles, key=lambda chunkFile: int( os.path.basename( chunkFile )[len( "eventTree_" ):-len( ".npz" )] ) )
+
+# Iterate over entries [entryStart, entryStop) in chunks of at most chunkSize.
+# branches = list of branch names, None for all.
+def iterateTree( filename, treeName="eventTree", branches=None, chunkSize=100000, entryStart=None, entryStop=None ):
+	filename = os.path.expanduser( filename )
+	if os.path.isdir( filename ):
+		for chunk in iterateNpz( filename, branches, chunkSize, entryStart, entryStop ):
+			yield chunk
+		return
+	import uproot
+	with uproot.open( filename ) as f:
+		for chunk in f[treeName].iterate( branches, step_size=chunkSize, entry_start=entryStart,
+		entry_stop=entryStop, library="np" ):
+			yield chunk
+
+# Same as iterateTree for an npz output directory.
+def iterateNpz( directory, branches=None, chunkSize=100000, entryStart=None, entryStop=None ):
+	start = 0 if entryStart is None else entryStart
+	stop = np.inf if entryStop is None else entryStop
+	first = 0 # Entry number of the first entry in the current file.
+	for chunkFile in getChunkFiles( directory ):
+		if first >= stop:
+			break
+		with np.load( chunkFile ) as arrays:
+			names = arrays.files if branches is None else branches
+			n = len( arrays[ arrays.files[0] ] )
+			low = int( max( start - first, 0 ) )
+			high = int( min( stop - first, n ) )
+			if low < high:
+				columns = { name: arrays[name][low:high] for name in names }
+				for offset in range( 0, high - low, chunkSize ):
+					yield { name: column[offset:offset + chunkSize] for name, column in columns.items() }
+		first += n
+
+# Read the whole selection into memory (concatenated chunks).
+def readTree( filename, treeName="eventTree", branches=None, chunkSize=100000, entryStart=None, entryStop=None ):
+	chunks = list( iterateTree( filename, treeName, branches, chunkSize, entryStart, entryStop ) )
+	if not chunks:
+		return {}
+	return { name: np.concatenate( [ chunk[name] for chunk in chunks ] ) for name in chunks[0] }
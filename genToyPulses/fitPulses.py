@@ -5,27 +5,40 @@
 #   1. Fit neutron population to get t_f, t_s components
 #   2. Fit combined gamma/neutron population to get distributions of t_r, R, etc.
 #
+# Both parts run in one go by default: the input is read once, the neutron population
+# is fitted, the mean t_f and t_s of those fits are fixed for the fit of all events.
+#
 # Usage:
-#       python fitPulsesNonRooFit.py
+#       python fitPulses.py <root file with sis3316tree> [--jobs N] [--output fitResults.root]
+#                           [--stages neutrons|all|both] [--fast-time t_f --slow-time t_s]
 #
-# Results will be stored in "fitResults.root"
+# Results will be stored in "fitResults.root": fitTree (all events, or the neutrons with
+# --stages neutrons), neutronFitTree (neutron fits when both stages ran) and fitSettings
+# (the t_f, t_s used for all events). --jobs N fits in N worker processes; trees are still
+# written in entry order, their entry branch holds each fit's entry number in sis3316tree.
 #
 # Notes:
 #   - Both this and the secondary code use samples rather than ns
 #   - The neutron cut, and all event cut (probably just an integral cut since low-E events
-#     are hard to fit) need to be set in the main loop. That's also where you'll set the
-#     t_f and t_s guesses and ranges, and if you're fixing them their fixed values.
+#     are hard to fit) are set in getCuts. The t_f and t_s guesses and ranges are set in
+#     getFitSetup, their fixed values for --stages all in fastTime_fixed/slowTime_fixed.
+#   - Each fit starts from the event's integral, baseline and onset estimate (waveformFeatures),
+#     all event fits of neutron events from their neutron fit.
+#   - Waveforms are read in blocks of blockSize entries and every block is fitted at once
+#     (fitBlock): a batched Levenberg-Marquardt on the same chi2 hist.Fit minimized (model
+#     at bin centers, errors sqrt(content), empty bins skipped) with an analytic Jacobian.
+#     Parameters are kept inside their limits by clipping every step to them.
 #
-import ROOT
-import sys
-import array
+import numpy as np
+import waveformFeatures
 
 def plotWaveform(wf):
+  import ROOT
   try:
     c1
   except NameError:
     c1=ROOT.TCanvas("c1","c1")
-    
+
   wflen=len(wf)
   ahist=ROOT.TH1D("ahist","ahist",wflen,0,wflen)
   for i in range(0,len(wf)):
@@ -38,9 +51,14 @@ def plotWaveform(wf):
   except SyntaxError:
     pass
   ahist.Delete()
-  
-fitNeutrons=1 #Set to 1 first, then look at fit results to get mean of t_f and t_s values
-              #Then set to 0 for full population
+
+#Fit stages run by default, see fitFile: neutrons first to get the mean t_f and t_s,
+#then the full population with those fixed
+fitStages=("neutrons","all","both")
+
+#t_f and t_s (samples) fixed for the full population when the neutron fit isn't run
+fastTime_fixed=1.343
+slowTime_fixed=10.831
 baselineBins=40 #How many sample for baseline
 waveformLength=300 #Full waveform length in samples
 channel=24 #Channel in tree to fit
@@ -66,140 +84,378 @@ riseTime_max=1.5
 plotRange_min=60
 plotRange_max=180
 
-inpFile=ROOT.TFile(sys.argv[1],"READ")
-tree=inpFile.Get("sis3316tree")
-nEntries=tree.GetEntries()
-print("Found "+str(nEntries)+" entries")
- 
-A=array.array('d',[0])
-onset=array.array('d',[0])
-riseTime=array.array('d',[0])
-R=array.array('d',[0])
-S=array.array('d',[0])
-fastTime=array.array('d',[0])
-slowTime=array.array('d',[0])
-slowestTime=array.array('d',[0])
-baseline=array.array('d',[0])
-psd=array.array('d',[0])
-
-outFile=ROOT.TFile("fitResults.root","RECREATE")
-fitTree=ROOT.TTree("fitTree","")
-fitTree.Branch('A',A,'A/D')
-fitTree.Branch('onset',onset,'onset/D')
-fitTree.Branch('R',R,'R/D')
-fitTree.Branch('S',S,'S/D')
-fitTree.Branch('riseTime',riseTime,'riseTime/D')
-fitTree.Branch('fastTime',fastTime,'fastTime/D')
-fitTree.Branch('slowTime',slowTime,'slowTime/D')
-fitTree.Branch('slowestTime',slowestTime,'slowestTime/D')
-fitTree.Branch('baseline',baseline,'baseline/D')
-fitTree.Branch('psd',psd,'psd/D')
- 
-for entry in range(0,int(nEntries)):
-
-  if (entry%1000==0):
-    print("On entry "+str(entry)+" of "+str(nEntries))
-
-  #Get entry
-  tree.GetEntry(entry)
-  
-  #If it's ch. 0, we'll fit
-  if tree.channelID==channel:
-  
-    ########################
-    ##Make data set to fit##
-    ########################
-    #Make a histogram to fit it
-    hist=ROOT.TH1D("hist","hist",waveformLength,0,waveformLength)
-    #Fill histogram
-    for i in range(0,waveformLength):
-      hist.SetBinContent(i+1,tree.waveform[i])
-      
-    ####################################
-    ##Get integral to guess amplitudes##
-    ####################################
-    base=0
-    for i in range(0,baselineBins):
-      base+=tree.waveform[i]
-    base=base*1./baselineBins
-    
-    integral=0
-    for i in range(integral_startSample,integral_endSample):
-      integral+=(tree.waveform[i]-base)
-    tailIntegral=0
-    for i in range(tailIntegral_startSample,tailIntegral_endSample):
-      tailIntegral+=(tree.waveform[i]-base)
-    
-    if integral>0:
-      psd[0]=tailIntegral*1./integral
+#Waveforms read and fitted together
+blockSize=10000
+
+#Entry ranges handed out per worker with --jobs, more than one for load balancing
+jobsPerWorker=4
+
+#Fit settings. Time constants are kept at least minTimeConstant (samples) so the
+#model stays finite where a limit is 0.
+maxIterations=100
+tolerance=1e-2 #Stop when the estimated distance to the minimum (EDM) is below this, as Minuit
+minTimeConstant=1e-3
+
+#Model parameters, in order
+parNames=("A","t0","t_r","R","t_f","t_s","baseline")
+timeConstants=[2,4,5] #t_r, t_f, t_s
+
+#fitTree branches, in order. entry is the waveform's entry number in sis3316tree.
+fitBranches=("A","onset","R","S","riseTime","fastTime","slowTime","slowestTime","baseline","psd","entry")
+fitBranchTypes={name:(np.int64 if name=="entry" else np.float64) for name in fitBranches}
+
+#Logistic function 1/(exp(-z)+1), saturating cleanly to 0 or 1.
+def logistic(z):
+  with np.errstate(over="ignore"):
+    return 1./(np.exp(-z)+1)
+
+#Pulse model [0]/(exp(([1]-x)/[2])+1) * ([3]/(exp((x-[1])/[4])+1) + (1-[3])/(exp((x-[1])/[5])+1)) + [6]
+#for parameters p (n x 7) at samples x, returns (n x len(x)).
+def pulseModel(x,p):
+  A,t0,t_r,R,t_f,t_s,base=[p[:,i,None] for i in range(7)]
+  u=x[None,:]-t0
+  return A*logistic(u/t_r)*(R*logistic(-u/t_f)+(1-R)*logistic(-u/t_s))+base
+
+#Model and its analytic Jacobian (n x 7 x len(x)).
+def pulseModelJacobian(x,p):
+  A,t0,t_r,R,t_f,t_s,base=[p[:,i,None] for i in range(7)]
+  u=x[None,:]-t0
+  F=logistic(u/t_r)
+  g=logistic(-u/t_f)
+  h=logistic(-u/t_s)
+  D=R*g+(1-R)*h
+  dF=F*(1-F) #dF/d(u/t_r)
+  dg=g*(1-g) #dg/d(-u/t_f)
+  dh=h*(1-h)
+  AF=A*F
+  jac=np.empty((len(p),7,len(x)))
+  jac[:,0]=F*D
+  jac[:,1]=A*(-dF/t_r*D+F*(R*dg/t_f+(1-R)*dh/t_s))
+  jac[:,2]=-A*D*dF*u/t_r**2
+  jac[:,3]=AF*(g-h)
+  jac[:,4]=AF*R*dg*u/t_f**2
+  jac[:,5]=AF*(1-R)*dh*u/t_s**2
+  jac[:,6]=1.
+  return AF*D+base,jac
+
+#Weighted chi2 of each waveform.
+def getChi2(x,p,waveforms,weights):
+  return np.sum(weights*np.square(waveforms-pulseModel(x,p)),axis=1)
+
+#Batched Levenberg-Marquardt fit of waveforms (n x samples).
+#  p0, low, high = (n x 7) starting values and limits (low==high fixes a parameter)
+#Returns the fitted parameters (n x 7) and chi2 (n).
+def levenbergMarquardt(waveforms,p0,low,high):
+  x=np.arange(waveforms.shape[1])+0.5 #Bin centers, as hist.Fit
+  #chi2 errors are sqrt(content), empty bins are skipped
+  weights=np.where(waveforms>0,1./np.where(waveforms>0,waveforms,1),0.)
+  free=(high>low).astype(float)
+  p=np.clip(p0,low,high)
+  chi2=getChi2(x,p,waveforms,weights)
+  lam=np.full(len(p),1.0) #Start damped, the first guesses can be far off
+  active=np.arange(len(p))
+  eye=np.eye(7)
+  for iteration in range(0,maxIterations):
+    if len(active)==0:
+      break
+    pa=p[active]
+    model,jac=pulseModelJacobian(x,pa)
+    w=weights[active]
+    resid=waveforms[active]-model
+    grad=np.matmul(jac,(w*resid)[:,:,None])[:,:,0]
+    #Parameters sitting on a limit that the gradient pushes against are held for
+    #this step (active set), so clipping doesn't stall the others
+    held=((pa<=low[active])&(grad<0))|((pa>=high[active])&(grad>0))
+    varied=free[active]*~held
+    jac=jac*varied[:,:,None]
+    grad=grad*varied
+    hess=np.matmul(jac*w[:,None,:],np.swapaxes(jac,1,2))
+    #Marquardt damping. Fixed parameters (and any the model doesn't depend on, e.g.
+    #everything but A at A=0) get a unit diagonal, their gradient is 0 so they don't move
+    diag=np.diagonal(hess,axis1=1,axis2=2)
+    unused=(diag<=0).astype(float)
+    damped=hess+(lam[active][:,None]*diag+unused)[:,:,None]*eye
+    step=np.linalg.solve(damped,grad[:,:,None])[:,:,0]
+    #EDM = chi2 drop a full Gauss-Newton step would give
+    newton=np.linalg.solve(hess+(1e-12*diag+unused)[:,:,None]*eye,grad[:,:,None])[:,:,0]
+    edm=np.sum(grad*newton,axis=1)
+    trial=np.clip(pa+step,low[active],high[active])
+    trialChi2=getChi2(x,trial,waveforms[active],w)
+    better=trialChi2<chi2[active]
+    p[active[better]]=trial[better]
+    lam[active]=np.where(better,lam[active]*0.1,lam[active]*10.)
+    #Done at the minimum, or when the damping has run away
+    done=(edm<tolerance)|(lam[active]>1e10)
+    chi2[active[better]]=trialChi2[better]
+    active=active[~done]
+  return p,chi2
+
+#Fit a block of waveforms (n x samples) at once, same arguments as levenbergMarquardt.
+#The time constants are held at their starting values for a first pass, otherwise
+#a large early step can collapse t_r or t_f onto its lower limit, where the chi2 is
+#flat in them and t0 and the fit gets stuck.
+def fitBlock(waveforms,p0,low,high):
+  waveforms=np.asarray(waveforms,dtype=float)
+  heldLow=low.copy()
+  heldHigh=high.copy()
+  heldLow[:,timeConstants]=heldHigh[:,timeConstants]=np.clip(p0,low,high)[:,timeConstants]
+  p,chi2=levenbergMarquardt(waveforms,p0,heldLow,heldHigh)
+  return levenbergMarquardt(waveforms,p,low,high)
+
+#Neutron and all event cuts from the pre-fit features.
+def getCuts(integral,psd):
+  neutronCut = (integral>=1000) & (integral<4500) & (psd>=0.3) & (psd<0.6)
+  allEventCut = integral>=1000
+  return neutronCut,allEventCut
+
+#Starting values and limits (n x 7) for each waveform.
+#  onset = per event t0 guesses (None for onsetTime_guess)
+#  fixedTimes = ( t_f, t_s ) to fix them, None to fit them (neutron fit)
+def getFitSetup(base,integral,onset=None,fixedTimes=None):
+  n=len(base)
+  p0=np.empty((n,7))
+  low=np.empty((n,7))
+  high=np.empty((n,7))
+
+  p0[:,0]=integral
+  low[:,0]=0
+  high[:,0]=integral*2.0
+
+  p0[:,1]=onsetTime_guess if onset is None else onset
+  low[:,1]=onsetTime_min
+  high[:,1]=onsetTime_max
+
+  p0[:,2]=riseTime_guess
+  low[:,2]=max(riseTime_min,minTimeConstant)
+  high[:,2]=riseTime_max
+
+  #Shouldn't need to change
+  p0[:,3]=0.90
+  low[:,3]=0
+  high[:,3]=1
+
+  if fixedTimes is None:
+    p0[:,4]=1.2
+    low[:,4]=minTimeConstant
+    high[:,4]=8.0
+
+    p0[:,5]=20.
+    low[:,5]=1.5
+    high[:,5]=60
+  else:
+    p0[:,4]=low[:,4]=high[:,4]=fixedTimes[0]
+    p0[:,5]=low[:,5]=high[:,5]=fixedTimes[1]
+
+  p0[:,6]=base
+  low[:,6]=np.minimum(base*0.8,base*1.2)
+  high[:,6]=np.maximum(base*0.8,base*1.2)
+  return p0,np.minimum(low,high),np.maximum(low,high)
+
+#Waveforms as a 2D array, whether the branch is a fixed size array or a vector.
+def getWaveformArray(waveforms):
+  if waveforms.dtype==object:
+    return np.stack([np.asarray(wf)[0:waveformLength] for wf in waveforms])
+  return waveforms
+
+#Feature stage: read the input once, compute the features of every waveform of the
+#channel in bulk and keep those passing the all event cut. Their waveforms are
+#cached in cacheFilename (raw samples, see openCache) for the fit stages.
+#Returns the events' features as a dict of arrays (entry, baseline, integral, psd,
+#onset, neutron) and the cache's sample dtype.
+def readEvents(inpFilename,cacheFilename):
+  import uproot
+  columns=[]
+  dtype=None
+  with uproot.open(inpFilename) as inpFile, open(cacheFilename,"wb") as cache:
+    tree=inpFile["sis3316tree"]
+    nEntries=tree.num_entries
+    print("Found "+str(nEntries)+" entries")
+    entry=0
+    for block in tree.iterate(["channelID","waveform"],step_size=blockSize,library="np"):
+      print("On entry "+str(entry)+" of "+str(nEntries))
+      entries=np.arange(entry,entry+len(block["channelID"]))
+      entry+=len(entries)
+      selected=block["channelID"]==channel
+      if not np.any(selected):
+        continue
+      waveforms=getWaveformArray(block["waveform"][selected])[:,0:waveformLength]
+      features=waveformFeatures.getFeatures(waveforms,baselineBins,integral_startSample,integral_endSample,
+        tailIntegral_startSample,tailIntegral_endSample)
+      neutronCut,allEventCut=getCuts(features["integral"],features["psd"])
+      if not np.any(allEventCut):
+        continue
+      if dtype is None:
+        dtype=waveforms.dtype
+      cache.write(np.ascontiguousarray(waveforms[allEventCut],dtype=dtype).tobytes())
+      onset=waveformFeatures.getOnset(waveforms[allEventCut],features["baseline"][allEventCut])
+      columns.append({"entry":entries[selected][allEventCut],"baseline":features["baseline"][allEventCut],
+        "integral":features["integral"][allEventCut],"psd":features["psd"][allEventCut],
+        "onset":np.clip(onset,onsetTime_min,onsetTime_max),"neutron":neutronCut[allEventCut]})
+  if len(columns)==0:
+    return None,dtype
+  return {name:np.concatenate([c[name] for c in columns]) for name in columns[0]},dtype
+
+#The cached waveforms ( nEvents x waveformLength ), memory mapped.
+def openCache(cacheFilename,dtype,nEvents):
+  return np.memmap(cacheFilename,dtype=dtype,mode="r",shape=(nEvents,waveformLength))
+
+#fitTree columns with no entries.
+def getEmptyFits():
+  return {name:np.zeros(0,dtype=fitBranchTypes[name]) for name in fitBranchTypes}
+
+#readEvents features of the given rows of the cache only.
+def selectEvents(events,rows):
+  return {name:column[rows] for name,column in events.items()}
+
+#Fit cached waveforms rows (indices into the cache), returns the fitTree columns.
+#  events = readEvents features of those rows (selectEvents), in the same order
+#  fixedTimes = ( t_f, t_s ) or None to fit them
+#  start = ( len(rows) x 7 ) starting parameters (e.g. from an earlier stage), NaN
+#          rows use the feature stage guesses
+def fitEvents(waveforms,events,rows,fixedTimes=None,start=None):
+  results=[]
+  for first in range(0,len(rows),blockSize):
+    block=slice(first,first+blockSize)
+    p0,low,high=getFitSetup(events["baseline"][block],events["integral"][block],events["onset"][block],fixedTimes)
+    if start is not None:
+      warm=start[first:first+blockSize]
+      known=~np.isnan(warm[:,0])
+      #Fixed time constants stay at their fixed values
+      columns=[0,1,2,3,6] if fixedTimes is not None else list(range(0,7))
+      p0[np.ix_(known,columns)]=warm[np.ix_(known,columns)]
+    p,chi2=fitBlock(np.asarray(waveforms[rows[block]]),p0,low,high)
+    zeros=np.zeros(len(p))
+    results.append({"A":p[:,0],"onset":p[:,1],"R":p[:,3],"S":zeros,"riseTime":p[:,2],"fastTime":p[:,4],
+      "slowTime":p[:,5],"slowestTime":zeros,"baseline":p[:,6],"psd":events["psd"][block],"entry":events["entry"][block]})
+  if len(results)==0:
+    return getEmptyFits()
+  return {name:np.concatenate([r[name] for r in results]).astype(fitBranchTypes[name]) for name in fitBranchTypes}
+
+#Worker process for --jobs, fits one range of cached waveforms into a partial npz file.
+#Gets only the features of its own rows, not of the whole cache.
+def runJob(args):
+  cacheFilename,dtype,nCached,events,rows,fixedTimes,start,partFilename=args
+  waveforms=openCache(cacheFilename,dtype,nCached)
+  np.savez(partFilename,**fitEvents(waveforms,events,rows,fixedTimes,start))
+  return len(rows)
+
+#Fit rows of the cache, in jobs worker processes if jobs>1. Each worker opens the
+#cache itself and writes its part to partDir; parts are merged in order, so the
+#result is the same as for a serial fit.
+def runStage(cacheFilename,dtype,events,rows,fixedTimes,start,jobs,partDir):
+  if jobs<=1:
+    return fitEvents(openCache(cacheFilename,dtype,len(events["entry"])),selectEvents(events,rows),rows,fixedTimes,start)
+
+  if len(rows)==0:
+    return getEmptyFits()
+  import os
+  import multiprocessing
+  if not os.path.isdir(partDir):
+    os.makedirs(partDir)
+  bounds=np.linspace(0,len(rows),jobs*jobsPerWorker+1).astype(int)
+  parts=[(cacheFilename,dtype,len(events["entry"]),selectEvents(events,rows[bounds[i]:bounds[i+1]]),rows[bounds[i]:bounds[i+1]],fixedTimes,
+    None if start is None else start[bounds[i]:bounds[i+1]],os.path.join(partDir,"part_%05d.npz"%i))
+    for i in range(0,len(bounds)-1) if bounds[i+1]>bounds[i]]
+  pool=multiprocessing.Pool(jobs)
+  try:
+    done=0
+    for n in pool.imap_unordered(runJob,parts):
+      done+=n
+      print("Fitted "+str(done)+" of "+str(len(rows))+" events")
+  finally:
+    pool.close()
+    pool.join()
+  results=[]
+  for part in parts:
+    with np.load(part[7]) as arrays:
+      results.append({name:arrays[name] for name in fitBranchTypes})
+  return {name:np.concatenate([r[name] for r in results]) for name in fitBranchTypes}
+
+#t_f and t_s for the all event fit from the neutron fits: the means over fits that
+#didn't end on a limit of either (all fits if none qualify).
+def getTimeConstants(neutronFits):
+  fast=neutronFits["fastTime"]
+  slow=neutronFits["slowTime"]
+  inside=(fast>minTimeConstant)&(fast<8.0)&(slow>1.5)&(slow<60)
+  if not np.any(inside):
+    inside=np.ones(len(fast),dtype=bool)
+  return float(np.mean(fast[inside])),float(np.mean(slow[inside]))
+
+#Run the fit stages on the input and write the results to outFilename.
+#  stages = "neutrons" (fit the neutron population, t_f and t_s free)
+#           "all"      (fit all events with t_f and t_s fixed to fixedTimes)
+#           "both"     (neutrons, then all events with t_f and t_s from the neutron
+#                       fits, starting neutron events from their neutron fit)
+#The input is read once; the waveforms passing the all event cut are cached on disk
+#(outFilename+".cache") between the stages.
+#fitTree holds the last stage, neutronFitTree the neutron fits when both stages ran,
+#and fitSettings the t_f and t_s the all event fit used.
+def fitFile(inpFilename,outFilename="fitResults.root",jobs=1,stages="both",fixedTimes=(fastTime_fixed,slowTime_fixed)):
+  import os
+  import shutil
+  import uproot
+  if stages not in fitStages:
+    raise ValueError("Unknown fit stages "+str(stages))
+  workDir=outFilename+".cache"
+  if not os.path.isdir(workDir):
+    os.makedirs(workDir)
+  cacheFilename=os.path.join(workDir,"waveforms.raw")
+  partDir=os.path.join(workDir,"parts")
+  try:
+    events,dtype=readEvents(inpFilename,cacheFilename)
+    empty={name:np.zeros(0,dtype=fitBranchTypes[name]) for name in fitBranchTypes}
+    neutronFits=allFits=None
+    if events is None:
+      print("No events pass the cuts")
+      neutronFits=allFits=empty
     else:
-      psd[0]=0
-      
-    ############
-    ##Make TF1##
-    ############
-    neutronCut = integral>=1000 and integral < 4500 and psd[0]>=0.3 and psd[0]<0.6
-    allEventCut = integral>=1000
-    if fitNeutrons==1:
-      cut=neutronCut
+      print(str(len(events["entry"]))+" events pass the all event cut, "+str(np.count_nonzero(events["neutron"]))+" the neutron cut")
+      if stages in ("neutrons","both"):
+        print("Fitting neutrons...")
+        neutronRows=np.flatnonzero(events["neutron"])
+        neutronFits=runStage(cacheFilename,dtype,events,neutronRows,None,None,jobs,partDir)
+      if stages=="both" and len(neutronFits["entry"])>0:
+        fixedTimes=getTimeConstants(neutronFits)
+        print("Neutron fits give t_f = "+str(fixedTimes[0])+", t_s = "+str(fixedTimes[1])+" samples")
+      if stages in ("all","both"):
+        print("Fitting all events...")
+        rows=np.arange(len(events["entry"]))
+        start=None
+        if neutronFits is not None and len(neutronFits["entry"])>0:
+          #Warm start neutron events from their neutron fit
+          start=np.full((len(rows),7),np.nan)
+          start[neutronRows]=np.column_stack([neutronFits[name] for name in
+            ("A","onset","riseTime","R","fastTime","slowTime","baseline")])
+        allFits=runStage(cacheFilename,dtype,events,rows,fixedTimes,start,jobs,partDir)
+  finally:
+    shutil.rmtree(workDir)
+
+  with uproot.recreate(outFilename) as outFile:
+    if stages=="neutrons":
+      trees={"fitTree":neutronFits}
+    elif stages=="all":
+      trees={"fitTree":allFits}
     else:
-      cut=allEventCut
-      
-    if allEventCut==1:
-      fit=ROOT.TF1("fit","[0]/(exp(([1]-x)/[2])+1) * ([3]/(exp((x-[1])/[4])+1) + (1-[3])/(exp((x-[1])/[5])+1)) + [6]",0,waveformLength)
-      
-      fit.SetParameter(0,integral)
-      fit.SetParLimits(0,0,integral*2.0)
-      fit.SetParName(0,"A")
-      
-      fit.SetParameter(1,onsetTime_guess)
-      fit.SetParLimits(1,onsetTime_min,onsetTime_max)
-      fit.SetParName(1,"t0")
-      
-      fit.SetParameter(2,riseTime_guess)
-      fit.SetParLimits(2,riseTime_min,riseTime_max)
-      fit.SetParName(2,"t_r")
-      
-      #Shouldn't need to change
-      fit.SetParameter(3,0.90)
-      fit.SetParLimits(3,0,1)
-      fit.SetParName(3,"R")
-      
-      if fitNeutrons==1:
-        fit.SetParName(4,"t_f")
-        fit.SetParameter(4,1.2)
-        fit.SetParLimits(4,0,8.0)
-        
-        fit.SetParName(5,"t_s")
-        fit.SetParameter(5,20.)
-        fit.SetParLimits(5,1.5,60)
-      else:
-        fit.SetParName(4,"t_f")
-        fit.FixParameter(4,1.343)
-      
-        fit.SetParName(5,"t_s")
-        fit.FixParameter(5,10.831)
-      
-      fit.SetParameter(6,base)
-      fit.SetParLimits(6,base*0.8,base*1.2)
-      fit.SetParName(6,"baseline")
-      
-      hist.Fit(fit,"QM0","",0,waveformLength)
-      hist.GetXaxis().SetRangeUser(plotRange_min,plotRange_max)
-      
-      A[0]=fit.GetParameter(0)
-      onset[0]=fit.GetParameter(1)
-      riseTime[0]=fit.GetParameter(2)
-      R[0]=fit.GetParameter(3)
-      fastTime[0]=fit.GetParameter(4)
-      slowTime[0]=fit.GetParameter(5)
-      baseline[0]=fit.GetParameter(6)
-      fitTree.Fill()
-      
-    ##Memory Management##
-    hist.Delete()
-
-outFile.cd()
-fitTree.Write()
-outFile.Close()
-inpFile.Close()
+      trees={"fitTree":allFits,"neutronFitTree":neutronFits}
+    for name,columns in trees.items():
+      outFile.mktree(name,fitBranchTypes)
+      if len(columns["entry"])>0:
+        outFile[name].extend(columns)
+    if stages!="neutrons":
+      outFile.mktree("fitSettings",{"fastTime":np.float64,"slowTime":np.float64})
+      outFile["fitSettings"].extend({"fastTime":np.array([fixedTimes[0]]),"slowTime":np.array([fixedTimes[1]])})
+
+def getParser():
+  import argparse
+  parser=argparse.ArgumentParser(description="Fit LS pulses in a sis3316tree")
+  parser.add_argument("input",help="root file with sis3316tree")
+  parser.add_argument("--output",default="fitResults.root",help="output file for fitTree")
+  parser.add_argument("--jobs",type=int,default=1,help="number of worker processes")
+  parser.add_argument("--stages",choices=fitStages,default="both",help="fit stages to run")
+  parser.add_argument("--fast-time",type=float,default=fastTime_fixed,help="fixed t_f in samples for --stages all")
+  parser.add_argument("--slow-time",type=float,default=slowTime_fixed,help="fixed t_s in samples for --stages all")
+  return parser
+
+if __name__=="__main__":
+  args=getParser().parse_args()
+  fitFile(args.input,args.output,args.jobs,args.stages,(args.fast_time,args.slow_time))
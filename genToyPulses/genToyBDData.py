@@ -5,22 +5,30 @@
 #
 # Functions:
 #   plotPulse(pulseList) - Plots a pulse on a TH1 based on a list of samples
-#   generateNoiseHistogram(filename, channel) - Looks at baseline samples from
-#     a specific channel to generate a noise histogram. Returns mean and stdev.
-#     This is used to identify a threshold for determining whether a baseline
-#     region is empty.
-#   generateNoiseSamples(filename,channel,mean,sigma) - Steps through a TTree
-#     and harvests as many empty baseline samples as possible. Returns a list
-#     of empty baselines.
+#   harvestNoise(filename, channel) - Reads the TTree once in chunks. Looks at
+#     baseline samples from a specific channel to generate a noise histogram,
+#     whose mean and stdev give a threshold for determining whether a baseline
+#     region is empty, and harvests as many empty baseline samples as possible.
+#     Returns mean, stdev and an array of empty baselines.
+#   fitNoiseHistogram(noiseHist) - Gaussian fit to the noise histogram
 #   combineNoiseToMakeWaveforms(noiseList) - Takes a list of empty waveform
-#     regions, and sticks them together to make continuous noise waveforms
-#   generatePulses(nPulses) - Generates toy BD pulses, add them to a noise
-#     waveform. Returns a list of fake pulses.
-#   generateToyDataTree(pulses,Rs,onsets,noiseTraces,channel) - Makes a fake
-#     data tree based on a list of fake pulses
+#     regions, and sticks them together to make continuous noise waveforms.
+#     Successors are looked up in a SuccessorIndex (buckets keyed on the first
+#     ADC value), so this is linear in the number of regions
+#   benchmarkStitching(nWindows) - Times combineNoiseToMakeWaveforms on
+#     synthetic noise windows
+#   generatePulses(nPulses) - Generates toy BD pulses in one go (onsets, neutron
+#     or gamma, R and amplitudes drawn as arrays, shapes evaluated as one
+#     broadcast). Returns an integer array of fake pulses, their Rs and onsets.
+#   generatePulseBlocks(nPulses) - Yields blocks of toyBlockSize fake pulses
+#   overlayNoiseBlocks(pulseBlocks,noiseTraces) - Adds noise to each block of
+#     pulses, drops saturated ones and computes true integrals and PSD
+#   generateToyDataTree(eventBlocks,channel) - Makes a fake data tree block by
+#     block, so memory doesn't grow with the number of pulses
 #
 # Usage:
 #   python genToyBDData.py <root file with sis3316tree>
+#   python genToyBDData.py --benchmark
 #
 #Notes:
 #   - Expects two root files of neutron energies (neutronHist.root) and
@@ -32,12 +40,12 @@
 #     in the code
 
 # Used to generate toy
-import ROOT
 import sys
 import random
+import time
 import numpy
 import math
-import array
+import waveformFeatures
 
 #
 fitNeutrons=1
@@ -61,6 +69,15 @@ tailIntegralDelay=7 #Start tail integral this many samples after integral starts
 #Which channel to use
 channel=24
 
+#Noise histogram: one bin per ADC value, gaussian fitted between noiseFit_min and
+#noiseFit_max ADC
+ADCRange=16384
+noiseFit_min=500
+noiseFit_max=2500
+
+#Entries read from the input file at a time when harvesting noise
+chunkSize=100000
+
 #Pulse onset location. Not really gaussian, but approximating it as such
 #Draw onset from this distribution
 onsetMean=106 #samples
@@ -69,10 +86,56 @@ onsetSigma=0.5#samples
 #How many fake pulses to generate
 nPulses=5030
 
+#Histograms (named "htemp") of neutron and gamma pulse amplitudes
+neutronHistFile="neutronHist.root"
+gammaHistFile="gammaHist.root"
+
+#Pulse shapes evaluated at a time
+pulseBlockSize=4096
+
+#Toy pulses generated, overlaid with noise and written at a time. Sets the memory
+#used apart from the noise traces
+toyBlockSize=100000
+
+#Branches of the output sis3316tree
+toyBranchTypes={"channelID":numpy.uint16,"timestamp":numpy.uint64,"peakHighIndex":numpy.uint16,
+  "peakHighValue":numpy.uint16,"pileupFlag":numpy.bool_,"nSamples":numpy.uint32,
+  "waveform":(numpy.uint16,(fullTraceSamples,)),"accumulatorSum":(numpy.uint32,(8,)),
+  "trueIntegral":numpy.float64,"R":numpy.float64,"psd":numpy.float64}
+
+'''
+#Forrest settings
+riseTime=2.1 #ns
+fastDecayComponent=5.45 #ns
+slowDecayComponent=52.0#ns
+
+t_r = riseTime/nsPerSample #rise time, samples
+t_f = t_f_n = t_f_g = fastDecayComponent/nsPerSample #fast decay comp., samples
+t_s = t_f_n = t_f_h = slowDecayComponent/nsPerSample #slow decay comp., samples
+
+#Use this for pulse shape https://arxiv.org/pdf/1912.07682.pdf
+R_neutrons = 0.949
+R_neutrons_sigma = 0.008
+R_gammas = 0.999
+R_gammas_sigma = 0.003
+'''
+
+#Use this for pulse shape https://arxiv.org/pdf/1912.07682.pdf
+#Data-based settings settings, in samples
+t_r = 0.289 #+-0.044
+t_f = 1.343 #+-0.378
+t_s = 10.831 #+-4.036
+
+R_neutrons = 0.920
+R_neutrons_sigma = 0.022
+R_gammas = 0.984
+R_gammas_sigma = 0.007
+
 
 
 #Plots a pulse based on a list of samples passed in.
 def plotPulse(pulseList):
+  import ROOT
   c1=ROOT.TCanvas("c1","c1")
   hist=ROOT.TH1D("hist","hist",len(pulseList),0,len(pulseList))
   for i in range(0,len(pulseList)):
@@ -86,286 +149,306 @@ def plotPulse(pulseList):
     pass
   hist.Delete()
 
-#Read in waveforms, analyze baseline regions to get noise TH1D
-def generateNoiseHistogram(filename,channel):
-  
-  #Read in sis3316tree, use first x samples to generate a histogram of noise.
-  inpFile=ROOT.TFile(filename,"READ")
-  tree=inpFile.Get("sis3316tree")
-  nEntries=tree.GetEntries()
-  
-  #Optimizations
-  channelIDBranch=tree.GetBranch("channelID")
-  waveformBranch=tree.GetBranch("waveform")
-  cacheSize=500000000
-  tree.SetCacheSize(cacheSize)
-  tree.AddBranchToCache(channelIDBranch,1)
-  tree.AddBranchToCache(waveformBranch,1)
-  tree.StopCacheLearningPhase()
-  
-  #Make Histogram
-  noiseHist = ROOT.TH1D("noiseHist","noiseHist;ADC;Counts",16384,0,16384)
-  
-  #Loop through TTree
-  for entry in range(0,nEntries):
-    tree.LoadTree(entry);
-    channelIDBranch.GetEntry(entry)
-    if tree.channelID==channel:
-      waveformBranch.GetEntry(entry)
-      
-      for sample in range(0,baselineSamples):
-        noiseHist.Fill(tree.waveform[sample])
-
-    if entry%100000==0:
-      print("On entry "+str(entry)+" of "+str(nEntries))
-  
-  fit=ROOT.TF1("fit","gaus",500,2500)
-  noiseHist.Fit(fit,"QR0","",500,2500)
-  mean=fit.GetParameter(1)
-  sigma=fit.GetParameter(2)
+#First baselineSamples+1 samples of each waveform as a 2D array, whether the branch
+#is a fixed size array or a vector.
+def getBaselineWindows(waveforms):
+  if waveforms.dtype==object:
+    return numpy.stack([numpy.asarray(wf)[0:baselineSamples+1] for wf in waveforms])
+  return waveforms[:,0:baselineSamples+1]
+
+#Gaussian fit to the noise histogram over [low,high) ADC, in place of the TH1 "gaus"
+#fit: chi2 of the non-empty bins with errors sqrt(counts), x at the bin centers as in
+#the TH1D. Starts from a parabola through the log of the bins around the peak (above
+#a tenth of the maximum), then Gauss-Newton steps. Returns mean,sigma.
+def fitNoiseHistogram(noiseHist,low=noiseFit_min,high=noiseFit_max,maxIterations=50):
+  counts=noiseHist[low:high].astype(float)
+  x=numpy.arange(low,high)+0.5
+  if counts.max()<=0:
+    raise ValueError("Noise histogram is empty between "+str(low)+" and "+str(high)+" ADC")
+  peak=numpy.argmax(counts)
+  below=numpy.flatnonzero(counts<0.1*counts[peak])
+  first=below[below<peak].max()+1 if numpy.any(below<peak) else 0
+  last=below[below>peak].min() if numpy.any(below>peak) else len(counts)
+  if last-first<3:
+    first,last=max(peak-1,0),min(peak+2,len(counts))
+  c,b,a=numpy.polyfit(x[first:last]-x[peak],numpy.log(counts[first:last]),2,w=numpy.sqrt(counts[first:last]))
+  if c>=0:
+    raise ValueError("Noise histogram has no peak between "+str(low)+" and "+str(high)+" ADC")
+  sigma=math.sqrt(-1./(2*c))
+  mean=x[peak]-b/(2*c)
+  amplitude=math.exp(a-b*b/(4*c))
+
+  filled=counts>0
+  counts,x=counts[filled],x[filled]
+  for iteration in range(0,maxIterations):
+    z=(x-mean)/sigma
+    model=amplitude*numpy.exp(-0.5*z*z)
+    jacobian=numpy.column_stack([model/amplitude,model*z/sigma,model*z*z/sigma])/numpy.sqrt(counts)[:,None]
+    step=numpy.linalg.lstsq(jacobian,(counts-model)/numpy.sqrt(counts),rcond=None)[0]
+    amplitude,mean,sigma=amplitude+step[0],mean+step[1],abs(sigma+step[2])
+    if abs(step[1])<1e-6*sigma and abs(step[2])<1e-6*sigma:
+      break
   return mean,sigma
 
-def generateNoiseSamples(filename,channel,mean,sigma):
-  #Samples to use for harvesting noise
-  threshold=mean+2*sigma
-
-  #Read in sis3316tree, use first x samples to generate a histogram of noise.
-  inpFile=ROOT.TFile(filename,"READ")
-  tree=inpFile.Get("sis3316tree")
-  nEntries=tree.GetEntries()
-
-  #Optimizations
-  channelIDBranch=tree.GetBranch("channelID")
-  waveformBranch=tree.GetBranch("waveform")
-  cacheSize=500000000
-  tree.SetCacheSize(cacheSize)
-  tree.AddBranchToCache(channelIDBranch,1)
-  tree.AddBranchToCache(waveformBranch,1)
-  tree.StopCacheLearningPhase()
-
-  noiseList=[]
-  
-  #Loop through TTree
-  for entry in range(0,nEntries):
-    tree.LoadTree(entry);
-    channelIDBranch.GetEntry(entry)
-    if tree.channelID==channel:
-      waveformBranch.GetEntry(entry)
-      
-      waveformList=[]
-      for sample in range(0,baselineSamples+1):
-        waveformList.append(tree.waveform[sample])
-
-      #print(sum(waveformList)/baselineSamples)
-      if sum(waveformList)*1./(baselineSamples+1) < threshold:
-        noiseList.append(waveformList)
-
-    if entry%100000==0:
+#Read the sis3316tree once, in chunks of chunkSize entries. For every waveform of
+#channel the first baselineSamples samples go into the noise histogram (ADC counts,
+#one bin per ADC value) and the first baselineSamples+1 samples are kept as a
+#candidate window (uint16 rows). The windows whose mean is below mean+2*sigma of the
+#histogram's gaussian fit are empty baselines.
+#Returns mean,sigma,noiseWindows (nWindows x baselineSamples+1).
+def harvestNoise(filename,channel):
+  import uproot
+  noiseHist=numpy.zeros(ADCRange,dtype=numpy.int64)
+  windows=[]
+  with uproot.open(filename) as inpFile:
+    tree=inpFile["sis3316tree"]
+    nEntries=tree.num_entries
+    entry=0
+    for chunk in tree.iterate(["channelID","waveform"],step_size=chunkSize,library="np"):
       print("On entry "+str(entry)+" of "+str(nEntries))
-      
-  return noiseList
+      entry+=len(chunk["channelID"])
+      selected=chunk["channelID"]==channel
+      if not numpy.any(selected):
+        continue
+      chunkWindows=getBaselineWindows(chunk["waveform"][selected]).astype(numpy.uint16)
+      noiseHist+=numpy.bincount(chunkWindows[:,0:baselineSamples].ravel(),minlength=ADCRange)[0:ADCRange]
+      windows.append(chunkWindows)
+  if len(windows)==0:
+    raise ValueError("No waveforms of channel "+str(channel)+" in "+filename)
+  windows=numpy.concatenate(windows)
+
+  mean,sigma=fitNoiseHistogram(noiseHist)
+  threshold=mean+2*sigma
+  windowMeans=waveformFeatures.getBaseline(windows,baselineSamples+1)
+  return mean,sigma,windows[windowMeans<threshold]
+
+#Index of noise windows by their first ADC value, for stitching. Each bucket is a
+#list of window indices; a window is removed by swapping it with the bucket's last
+#element, so taking a random successor or a given window is O(1).
+class SuccessorIndex:
+  def __init__(self,firstADC):
+    self.buckets={}
+    self.position=numpy.empty(len(firstADC),dtype=numpy.int64)
+    for index,adc in enumerate(firstADC.tolist()):
+      bucket=self.buckets.setdefault(adc,[])
+      self.position[index]=len(bucket)
+      bucket.append(index)
+    self.firstADC=firstADC
+
+  #Remove window index from its bucket.
+  def remove(self,index):
+    bucket=self.buckets[self.firstADC[index]]
+    last=bucket.pop()
+    if last!=index:
+      bucket[self.position[index]]=last
+      self.position[last]=self.position[index]
+
+  #Remove and return a random window starting at adc, None if there is none.
+  def popRandom(self,adc):
+    bucket=self.buckets.get(adc)
+    if not bucket:
+      return None
+    index=bucket[random.randrange(len(bucket))]
+    self.remove(index)
+    return index
 
 def combineNoiseToMakeWaveforms(noiseList):
-  
-  noiseTraces=[]
+  #Windows as rows of baselineSamples+1 samples, the last one only used for matching
+  windows=numpy.asarray(noiseList).reshape(-1,baselineSamples+1)
+  nWindows=len(windows)
+  windowsPerTrace=fullTraceSamples//baselineSamples
+  successors=SuccessorIndex(windows[:,0])
+  lastADCs=windows[:,baselineSamples].tolist()
+  used=numpy.zeros(nWindows,dtype=bool)
+
+  #Same procedure as before: start a trace from the first unused window, append random
+  #windows whose first sample matches the last sample so far, and drop the trace if
+  #there is none. Traces are built as lists of window indices.
+  traces=[]
   currentTrace=[]
-  
-  while len(noiseList)>0:
-  
-    if (len(noiseList)%1000==0):
-      print(str(len(noiseList))+" partial noise waveform samples remaining")
-  
-    #Grab the first entry if there is not a current entry
+  nextStart=0
+  remaining=nWindows
+  while remaining>0:
+
+    if (remaining%100000==0):
+      print(str(remaining)+" partial noise waveform samples remaining")
+
     if len(currentTrace)==0:
-      currentTrace=noiseList.pop(0)
-      lastADC=currentTrace.pop(len(currentTrace)-1)
+      while used[nextStart]:
+        nextStart+=1
+      index=nextStart
+      successors.remove(index)
     else:
-      #Get list of possible waveforms to add to it
-      possibleWaveforms = [i for i in noiseList if i[0]==lastADC]
-      
-      #If there's at least one possible waveform to add, choose a
-      #random valid waveform, remove from list, and add to our current trace
-      if len(possibleWaveforms)!=0:
-        nextElement=possibleWaveforms.pop(random.randrange(len(possibleWaveforms)))
-        noiseList.remove(nextElement)
-        currentTrace.extend(nextElement)
-        lastADC=currentTrace.pop(len(currentTrace)-1)
-      else:
-        #No valid succesors found, delete the trace we've built so far
+      index=successors.popRandom(lastADC)
+      if index is None:
+        #No valid successors found, delete the trace we've built so far
         currentTrace=[]
-        
-    if len(currentTrace)==fullTraceSamples:
-      noiseTraces.append(currentTrace)
+        continue
+    used[index]=True
+    remaining-=1
+    currentTrace.append(index)
+    lastADC=lastADCs[index]
+
+    if len(currentTrace)==windowsPerTrace:
+      traces.append(currentTrace)
       currentTrace=[]
-      
-  return noiseTraces
-  
-#Generates pulses
-def generatePulses(nPulses):
-
-  nPulsesToGenerate=nPulses
-  
-  pulseLength=fullTraceSamples #samples
-
-  '''
-  #Forrest settings
-  riseTime=2.1 #ns
-  fastDecayComponent=5.45 #ns
-  slowDecayComponent=52.0#ns
-  
-  t_r = riseTime/nsPerSample #rise time, samples
-  t_f = t_f_n = t_f_g = fastDecayComponent/nsPerSample #fast decay comp., samples
-  t_s = t_f_n = t_f_h = slowDecayComponent/nsPerSample #slow decay comp., samples
-  
-  #Use this for pulse shape https://arxiv.org/pdf/1912.07682.pdf
-  R_neutrons = 0.949
-  R_neutrons_sigma = 0.008
-  R_gammas = 0.999
-  R_gammas_sigma = 0.003
-  '''
-  
-  #Use this for pulse shape https://arxiv.org/pdf/1912.07682.pdf
-  #Data-based settings settings
-  t_r = 0.289 #+-0.044
-  t_f = 1.343 #+-0.378
-  t_s = 10.831 #+-4.036
-  
-  R_neutrons = 0.920
-  R_neutrons_sigma = 0.022
-  R_gammas = 0.984
-  R_gammas_sigma = 0.007
-  
+
+  if len(traces)==0:
+    return numpy.zeros((0,fullTraceSamples),dtype=windows.dtype)
+  return windows[numpy.array(traces),0:baselineSamples].reshape(len(traces),fullTraceSamples)
+
+#Time combineNoiseToMakeWaveforms on synthetic noise: nWindows windows of
+#baselineSamples+1 gaussian samples around a typical baseline.
+def benchmarkStitching(nWindows=1000000,baseline=1500,noiseSigma=3,seed=1):
+  random.seed(seed)
+  rng=numpy.random.default_rng(seed)
+  for n in (nWindows//10,nWindows):
+    noiseList=numpy.rint(rng.normal(baseline,noiseSigma,(n,baselineSamples+1))).astype(numpy.uint16)
+    startTime=time.time()
+    noiseTraces=combineNoiseToMakeWaveforms(noiseList)
+    print("Stitched "+str(n)+" windows into "+str(len(noiseTraces))+" traces in "+str(round(time.time()-startTime,2))+" s")
+
+#Amplitude histogram as (bin edges, cumulative fraction at each edge).
+def loadAmplitudeHistogram(filename):
+  import uproot
+  with uproot.open(filename) as histFile:
+    contents,edges=histFile["htemp"].to_numpy()
+  cdf=numpy.concatenate(([0.],numpy.cumsum(numpy.clip(contents,0,None))))
+  return edges,cdf/cdf[-1]
+
+#n random values from an amplitude histogram like TH1::GetRandom, a bin by its
+#content, then uniform within the bin.
+def sampleAmplitudes(histogram,n,rng):
+  edges,cdf=histogram
+  u=rng.random(n)
+  bins=numpy.clip(numpy.searchsorted(cdf,u,side="right")-1,0,len(edges)-2)
+  with numpy.errstate(divide="ignore",invalid="ignore"):
+    x=numpy.where(cdf[bins+1]>cdf[bins],(u-cdf[bins])/(cdf[bins+1]-cdf[bins]),0.5)
+  return edges[bins]+x*(edges[bins+1]-edges[bins])
+
+#Pulse shape A*f*(R*g+(1-R)*h) at samples 0...pulseLength-1 for arrays of A, t0 and R,
+#returns (n x pulseLength) floats.
+def pulseShape(A,t0,R,pulseLength=fullTraceSamples):
+  dt=numpy.arange(pulseLength)[None,:]-numpy.asarray(t0,dtype=float)[:,None]
+  R=numpy.asarray(R,dtype=float)[:,None]
+  with numpy.errstate(over="ignore"):
+    f = 1./(numpy.exp(-dt/t_r)+1)
+    g = 1./(numpy.exp(dt/t_f)+1)
+    h = 1./(numpy.exp(dt/t_s)+1)
+  return numpy.asarray(A,dtype=float)[:,None]*f*(R*g+(1-R)*h)
+
+#Generates nPulses pulses at once. Returns pulses as an (nPulses x fullTraceSamples)
+#int32 array (samples truncated like int()), and an R and an integer onset per pulse.
+def generatePulses(nPulses,rng=None,neutronHist=None,gammaHist=None):
+  if rng is None:
+    rng=numpy.random.default_rng()
+
   #Use data-pulled distributions of energy of pulses
-  neutronHistFile=ROOT.TFile("neutronHist.root","READ")
-  neutronHist=neutronHistFile.Get("htemp")
-  gammaHistFile=ROOT.TFile("gammaHist.root","READ")
-  gammaHist=gammaHistFile.Get("htemp")
-  
-  pulses=[]
-  onsets=[]
-  Rs=[]
-  
-  for ipulse in range(0,nPulsesToGenerate):
-
-    pulse=[]
-    
-    #Get onset, assume normally distributed independent of shape, amplitude
-    t0 = numpy.random.normal(onsetMean,onsetSigma)
-    
-    #Determine whether this is a neutron or gamma with equal probability
-    isNeutron = numpy.random.uniform(0,2)
-    
-    #Sample from appropriate energy distribution
-    if isNeutron>=1:
-      A = neutronHist.GetRandom()
-      R = numpy.random.normal(R_neutrons,R_neutrons_sigma)
-    else:
-      A = gammaHist.GetRandom()
-      R = numpy.random.normal(R_gammas,R_gammas_sigma)
-      
-    #Sample from timing distributions
-
-    #Generate shape
-    for sample in range(0,pulseLength):
-      f = 1./(math.exp(-(sample-t0)/t_r)+1)
-      g = 1./(math.exp((sample-t0)/t_f)+1)
-      h = 1./(math.exp((sample-t0)/t_s)+1)
-      
-      pulse.append(int(A * f * (R*g+(1-R)*h)))
-      onsets.append(int(t0))
-
-    Rs.append(R)
-    pulses.append(pulse)
-    
-  return pulses,Rs,onsets
-      
-def generateToyDataTree(pulses,Rs,onsets,noiseTraces,channel):
-  
-  numSamples=fullTraceSamples
-  
-  #Output file
-  outFile=ROOT.TFile(outputName,"RECREATE")
-  sis3316tree=ROOT.TTree("sis3316tree","Unsorted events")
-  channelID=array.array('H',[0])
-  timestamp=array.array('L',[0])
-  peakHighIndex=array.array('H',[0])
-  peakHighValue=array.array('H',[0])
-  pileupFlag=array.array('H',[0])
-  nSamples=array.array('i',[0])
-  accumulatorSum=array.array('d',8*[0])
-  waveform=array.array('H',numSamples*[0])
-  trueIntegral=array.array('d',[0])
-  R=array.array('d',[0])
-  psd=array.array('d',[0])
-  
-  sis3316tree.Branch('channelID',channelID,'channelID/s')
-  sis3316tree.Branch('timestamp',timestamp,'timestamp/l')
-  sis3316tree.Branch('peakHighIndex',peakHighIndex,'peakHighIndex/s')
-  sis3316tree.Branch('peakHighValue',peakHighValue,'peakHighValue/s')
-  sis3316tree.Branch('pileupFlag',pileupFlag,'pileupFlag/O')
-  sis3316tree.Branch('nSamples',nSamples,'nSamples/i')
-  sis3316tree.Branch('waveform',waveform,'waveform[300]/s')
-  sis3316tree.Branch('accumulatorSum',accumulatorSum,'accumulatorSum[8]/i')
-  
-  sis3316tree.Branch('trueIntegral',trueIntegral,'trueIntegral/D')
-  sis3316tree.Branch('R',R,'R/D')
-  sis3316tree.Branch('psd',psd,'psd/D')
-  
-  channelID[0]=channel
-  timestamp[0]=0
-  peakHighIndex[0]=0
-  peakHighValue[0]=0
-  pileupFlag[0]=0
-  nSamples[0]=fullTraceSamples
-  
-  for pulseNum in range(0,len(pulses)):
-    pulse=pulses[pulseNum]
-    R[0]=Rs[pulseNum]
-    noiseTrace=noiseTraces[random.randrange(len(noiseTraces))]
-    realPulse=[(a + b) for a, b in zip(pulse, noiseTrace)]
-    #plotPulse(noiseTrace)
-    #plotPulse(pulse)
-    #plotPulse(realPulse)
-    saturatedEvents=[i for i in realPulse if i >= 16384]
-    if len(saturatedEvents)==0:
-      for i in range(0,len(pulse)):
-        waveform[i]=realPulse[i]
-      
-      if onsets[i]+integrationLength < fullTraceSamples:
-        integratedSection=[pulse[i] for i in range(onsets[i],onsets[i]+integrationLength)]
-        tailIntegralSection=[pulse[i] for i in range(onsets[i]+tailIntegralDelay,onsets[i]+integrationLength)]
-        trueIntegral[0]=sum(integratedSection)
-        tailIntegral=sum(tailIntegralSection)
-        if tailIntegral>0:
-          psd[0]=tailIntegral/trueIntegral[0]
-          sis3316tree.Fill()
-      
-  sis3316tree.Write()
-  outFile.Close()
-
-
-
-#Make histogram of baselines, generate mean and sigma
-print("Calculating Baseline...")
-mean,sigma = generateNoiseHistogram(sys.argv[1],channel)
-print("Baseline is "+str(mean)+" +- "+str(sigma)+"\n")
-
-#Make list of noise trace samples
-print("Generating noise samples...")
-noiseList=generateNoiseSamples(sys.argv[1],channel,mean,sigma)
-print("Found "+str(len(noiseList))+" valid baseline windows\n")
-
-#make noise traces
-print("Generating noise traces...")
-noiseTraces=combineNoiseToMakeWaveforms(noiseList)
-print("Generated "+str(len(noiseTraces))+" noise traces\n")
-
-#Make raw pulses
-print("Generating fake pulse shapes...")
-pulses,Rs,onsets=generatePulses(nPulses)
-print("Generated "+str(nPulses)+" fake pulse shapes\n")
-
-#Make fake pulses
-print("Making fake pulses...")
-generateToyDataTree(pulses,Rs,onsets,noiseTraces,channel)
-print("Done!")
+  if neutronHist is None:
+    neutronHist=loadAmplitudeHistogram(neutronHistFile)
+  if gammaHist is None:
+    gammaHist=loadAmplitudeHistogram(gammaHistFile)
+
+  #Get onset, assume normally distributed independent of shape, amplitude
+  t0 = rng.normal(onsetMean,onsetSigma,nPulses)
+
+  #Determine whether this is a neutron or gamma with equal probability, and sample
+  #from appropriate energy distribution
+  isNeutron = rng.random(nPulses)<0.5
+  nNeutrons = numpy.count_nonzero(isNeutron)
+  A = numpy.empty(nPulses)
+  A[isNeutron] = sampleAmplitudes(neutronHist,nNeutrons,rng)
+  A[~isNeutron] = sampleAmplitudes(gammaHist,nPulses-nNeutrons,rng)
+  R = numpy.where(isNeutron,rng.normal(R_neutrons,R_neutrons_sigma,nPulses),rng.normal(R_gammas,R_gammas_sigma,nPulses))
+
+  #Generate shape, pulseBlockSize pulses at a time to bound the float temporaries
+  pulses = numpy.empty((nPulses,fullTraceSamples),dtype=numpy.int32)
+  for start in range(0,nPulses,pulseBlockSize):
+    block = slice(start,start+pulseBlockSize)
+    pulses[block] = numpy.trunc(pulseShape(A[block],t0[block],R[block]))
+  onsets = numpy.trunc(t0).astype(numpy.int64)
+  return pulses,R,onsets
+
+#Pulse blocks for nPulses toy pulses, blockSize at a time: yields (pulses,Rs,onsets)
+#as returned by generatePulses.
+def generatePulseBlocks(nPulses,blockSize=toyBlockSize,rng=None):
+  if rng is None:
+    rng=numpy.random.default_rng()
+  neutronHist=loadAmplitudeHistogram(neutronHistFile)
+  gammaHist=loadAmplitudeHistogram(gammaHistFile)
+  for start in range(0,nPulses,blockSize):
+    yield generatePulses(min(blockSize,nPulses-start),rng,neutronHist,gammaHist)
+
+#Adds a random noise trace to each pulse of a block, drops saturated pulses and
+#pulses whose integration window doesn't fit in the trace or without a positive
+#tail integral. True integrals start at each pulse's onset and come from prefix sums
+#of the noiseless pulses (waveformFeatures). Returns the kept events as a dict of
+#arrays (waveform, trueIntegral, R, psd).
+def overlayNoise(pulses,Rs,onsets,noiseTraces,rng):
+  noiseTraces=numpy.asarray(noiseTraces)
+  realPulses=pulses+noiseTraces[rng.integers(len(noiseTraces),size=len(pulses))]
+  unsaturated=numpy.all(realPulses<ADCRange,axis=1)
+  features=waveformFeatures.getFeatures(pulses,0,onsets,onsets+integrationLength,
+    onsets+tailIntegralDelay,onsets+integrationLength)
+  kept=unsaturated & (onsets+integrationLength<fullTraceSamples) & (features["tailIntegral"]>0)
+  return {"waveform":realPulses[kept].astype(numpy.uint16),"trueIntegral":features["integral"][kept].astype(numpy.float64),
+    "R":numpy.asarray(Rs,dtype=numpy.float64)[kept],"psd":features["psd"][kept]}
+
+#Event blocks ready to write, one per pulse block.
+def overlayNoiseBlocks(pulseBlocks,noiseTraces,rng=None):
+  if rng is None:
+    rng=numpy.random.default_rng()
+  for pulses,Rs,onsets in pulseBlocks:
+    yield overlayNoise(pulses,Rs,onsets,noiseTraces,rng)
+
+#Writes event blocks to a sis3316tree in outputName, one basket per block, so only
+#one block is in memory at a time. Returns the number of events written.
+def generateToyDataTree(eventBlocks,channel,outputName=outputName):
+  import uproot
+  nEvents=0
+  with uproot.recreate(outputName) as outFile:
+    outFile.mktree("sis3316tree",toyBranchTypes,title="Unsorted events")
+    for events in eventBlocks:
+      n=len(events["R"])
+      if n==0:
+        continue
+      branches={
+        "channelID":numpy.full(n,channel,dtype=numpy.uint16),
+        "timestamp":numpy.zeros(n,dtype=numpy.uint64),
+        "peakHighIndex":numpy.zeros(n,dtype=numpy.uint16),
+        "peakHighValue":numpy.zeros(n,dtype=numpy.uint16),
+        "pileupFlag":numpy.zeros(n,dtype=numpy.bool_),
+        "nSamples":numpy.full(n,fullTraceSamples,dtype=numpy.uint32),
+        "accumulatorSum":numpy.zeros((n,8),dtype=numpy.uint32)}
+      branches.update(events)
+      outFile["sis3316tree"].extend(branches)
+      nEvents+=n
+      print("Wrote "+str(nEvents)+" events")
+  return nEvents
+
+def main(filename):
+  #Make histogram of baselines, generate mean and sigma, and keep the empty baselines
+  print("Harvesting noise samples...")
+  mean,sigma,noiseList=harvestNoise(filename,channel)
+  print("Baseline is "+str(mean)+" +- "+str(sigma))
+  print("Found "+str(len(noiseList))+" valid baseline windows\n")
+
+  #make noise traces
+  print("Generating noise traces...")
+  noiseTraces=combineNoiseToMakeWaveforms(noiseList)
+  print("Generated "+str(len(noiseTraces))+" noise traces\n")
+
+  #Make fake pulses block by block: pulse shapes, noise, integrals, write
+  print("Making fake pulses...")
+  rng=numpy.random.default_rng()
+  pulseBlocks=generatePulseBlocks(nPulses,toyBlockSize,rng)
+  eventBlocks=overlayNoiseBlocks(pulseBlocks,noiseTraces,rng)
+  nEvents=generateToyDataTree(eventBlocks,channel)
+  print("Wrote "+str(nEvents)+" of "+str(nPulses)+" fake pulses to "+outputName)
+  print("Done!")
+
+if __name__=="__main__":
+  if sys.argv[1]=="--benchmark":
+    benchmarkStitching()
+  else:
+    main(sys.argv[1])
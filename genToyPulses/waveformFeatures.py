@@ -0,0 +1,98 @@
+# Baseline, integral, tail integral and PSD of digitizer waveforms.
+#
+# Works on a whole block of waveforms at once (2D array, one waveform per row).
+# Every window sum is a difference of two entries of the row's cumulative sum, so
+# any number of windows costs one pass over the samples, and windows may start at
+# a different sample in every row (e.g. at each pulse's onset).
+#
+# Used by fitPulses.py (pre-cut and starting values for the fits) and
+# genToyBDData.py (noise harvesting, true integrals of toy pulses).
+#
+# Usage:
+#   import waveformFeatures
+#   features=waveformFeatures.getFeatures(waveforms)
+#   cut=(features["integral"]>=1000) & (features["psd"]>=0.3)
+#
+# Windows are [start, end) in samples. The defaults match fitPulses.py.
+#
+import numpy as np
+
+baselineBins=40 #How many samples for baseline, from sample 0
+
+#Integral window
+integral_startSample=100
+integral_endSample=300
+
+#Tail integral window for PSD
+tailIntegral_startSample=113
+tailIntegral_endSample=300
+
+#Cumulative sums with a leading 0, (n x samples+1). Integer waveforms are summed
+#exactly in int64.
+def getCumulative(waveforms):
+  waveforms=np.asarray(waveforms)
+  dtype=np.int64 if np.issubdtype(waveforms.dtype,np.integer) else np.float64
+  cumulative=np.zeros((waveforms.shape[0],waveforms.shape[1]+1),dtype=dtype)
+  np.cumsum(waveforms,axis=1,dtype=dtype,out=cumulative[:,1:])
+  return cumulative
+
+#Window edges as one [start, end) per row, clipped to the waveform (end >= start).
+def getWindow(cumulative,start,end):
+  numSamples=cumulative.shape[1]-1
+  rows=cumulative.shape[0]
+  start=np.clip(np.broadcast_to(start,(rows,)),0,numSamples)
+  end=np.clip(np.broadcast_to(end,(rows,)),start,numSamples)
+  return start,end
+
+#Sum of each row over [start, end), start/end = scalars or one per row.
+def windowSum(cumulative,start,end):
+  start,end=getWindow(cumulative,start,end)
+  rows=np.arange(cumulative.shape[0])
+  return cumulative[rows,end]-cumulative[rows,start]
+
+#Mean of the first baselineBins samples of each row.
+def getBaseline(waveforms,baselineBins=baselineBins,cumulative=None):
+  if cumulative is None:
+    cumulative=getCumulative(np.asarray(waveforms)[:,0:baselineBins])
+  return cumulative[:,baselineBins]/float(baselineBins)
+
+#Tail over total integral, 0 where the integral isn't positive.
+def getPSD(integral,tailIntegral):
+  with np.errstate(divide="ignore",invalid="ignore"):
+    return np.where(integral>0,tailIntegral/integral,0.)
+
+#Baseline, integral, tail integral and psd of every row, as a dict of arrays.
+#Integrals are baseline subtracted; with baselineBins=0 no baseline is subtracted
+#(e.g. for noiseless toy pulses). Window edges can be arrays with one per row.
+def getFeatures(waveforms,baselineBins=baselineBins,integralStart=integral_startSample,
+  integralEnd=integral_endSample,tailStart=tailIntegral_startSample,tailEnd=tailIntegral_endSample):
+  cumulative=getCumulative(waveforms)
+  if baselineBins>0:
+    baseline=getBaseline(waveforms,baselineBins,cumulative)
+  else:
+    baseline=np.zeros(cumulative.shape[0])
+  integralStart,integralEnd=getWindow(cumulative,integralStart,integralEnd)
+  tailStart,tailEnd=getWindow(cumulative,tailStart,tailEnd)
+  integral=windowSum(cumulative,integralStart,integralEnd)-baseline*(integralEnd-integralStart)
+  tailIntegral=windowSum(cumulative,tailStart,tailEnd)-baseline*(tailEnd-tailStart)
+  return {"baseline":baseline,"integral":integral,"tailIntegral":tailIntegral,"psd":getPSD(integral,tailIntegral)}
+
+#Pulse onset estimate of each row in samples: where the rising edge before the
+#largest sample in [start, end) crosses fraction of that peak (above baseline),
+#linearly interpolated, on the same bin-center scale as the fit (sample i at i+0.5).
+#Rows without a rising edge in the window get the peak position.
+def getOnset(waveforms,baseline,start=integral_startSample,end=integral_endSample,fraction=0.5):
+  pulse=np.asarray(waveforms,dtype=float)[:,start:end]-np.asarray(baseline,dtype=float)[:,None]
+  rows=np.arange(pulse.shape[0])
+  peak=np.argmax(pulse,axis=1)
+  level=fraction*pulse[rows,peak]
+  samples=np.arange(pulse.shape[1])
+  below=(pulse<level[:,None])&(samples[None,:]<peak[:,None])
+  last=np.max(np.where(below,samples[None,:],-1),axis=1)
+  found=last>=0
+  last=np.where(found,last,peak)
+  y0=pulse[rows,last]
+  y1=pulse[rows,np.minimum(last+1,pulse.shape[1]-1)]
+  with np.errstate(divide="ignore",invalid="ignore"):
+    step=np.where(found&(y1>y0),(level-y0)/(y1-y0),0.)
+  return start+last+0.5+step